@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+pipe_throughput - benchmark the throughput of smallparts.pipelines
+ProcessPipeline instances with different pipe buffer sizes
+(pipe_size argument) between the stages
+
+"""
+
+
+import argparse
+import json
+import sys
+import time
+
+from smallparts import pipelines
+
+
+MEBIBYTE = 1024 * 1024
+KIBIBYTE = 1024
+
+
+def measure(pipe_size, stages, volume, repetitions):
+    """Return the best throughput in MiB/s of sending volume MiB
+    from /dev/zero through the given number of cat stages
+    """
+    commands = [['head', '-c', str(volume * MEBIBYTE), '/dev/zero']]
+    commands.extend(['cat'] for unused_stage in range(stages))
+    commands.append(['wc', '-c'])
+    best_time = None
+    for unused_repetition in range(repetitions):
+        start_time = time.perf_counter()
+        result = pipelines.ProcessPipeline(
+            *commands,
+            pipe_size=pipe_size,
+            check=True).result
+        elapsed_time = time.perf_counter() - start_time
+        if int(result.stdout) != volume * MEBIBYTE:
+            raise ValueError('Unexpected output: {0!r}'.format(result.stdout))
+        #
+        if best_time is None or elapsed_time < best_time:
+            best_time = elapsed_time
+        #
+    #
+    return volume / best_time
+
+
+def main(arguments=None):
+    """Run the benchmark"""
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip())
+    argument_parser.add_argument(
+        '--sizes',
+        type=int,
+        nargs='+',
+        default=[0, 64, 256, 1024],
+        help='Pipe sizes in KiB, 0 meaning the system default'
+        ' (default: %(default)s)')
+    argument_parser.add_argument(
+        '--stages',
+        type=int,
+        default=4,
+        help='Number of cat stages (default: %(default)s)')
+    argument_parser.add_argument(
+        '--volume',
+        type=int,
+        default=512,
+        help='Data volume in MiB (default: %(default)s)')
+    argument_parser.add_argument(
+        '--repetitions',
+        type=int,
+        default=3,
+        help='Runs per measurement, the best is reported'
+        ' (default: %(default)s)')
+    argument_parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Print machine-readable JSON output')
+    options = argument_parser.parse_args(arguments)
+    measurements = []
+    for size in options.sizes:
+        pipe_size = size * KIBIBYTE or None
+        measurements.append(
+            dict(pipe_size=pipe_size,
+                 stages=options.stages,
+                 volume_mib=options.volume,
+                 mib_per_second=measure(
+                     pipe_size,
+                     options.stages,
+                     options.volume,
+                     options.repetitions)))
+    #
+    if options.json:
+        json.dump(measurements, sys.stdout, indent=2)
+        print()
+        return 0
+    #
+    print('{0:>12} {1:>8} {2:>12}'.format('pipe size', 'stages', 'MiB/s'))
+    for record in measurements:
+        if record['pipe_size'] is None:
+            size_display = 'default'
+        else:
+            size_display = '{0} KiB'.format(record['pipe_size'] // KIBIBYTE)
+        #
+        print('{0:>12} {1:>8} {2:>12.1f}'.format(
+            size_display, record['stages'], record['mib_per_second']))
+    #
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim:fileencoding=utf-8 autoindent ts=4 sw=4 sts=4 expandtab:
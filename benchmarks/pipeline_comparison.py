@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+pipeline_comparison - benchmark smallparts.pipelines ProcessPipeline
+and ProcessChain instances against equivalent /bin/sh -c pipelines:
+spawn latency, throughput through 1 to 8 stages,
+and peak RSS of the Python parent process for different data volumes
+
+"""
+
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import smallparts
+
+from smallparts import pipelines
+
+
+MEBIBYTE = 1024 * 1024
+
+SHELL = 'shell'
+PIPELINE = 'pipeline'
+CHAIN = 'chain'
+IMPLEMENTATIONS = (SHELL, PIPELINE, CHAIN)
+
+# Marker for the worker mode (one measurement per fresh interpreter,
+# so the peak RSS is not influenced by previous measurements)
+WORKER_OPTION = '--worker'
+
+
+def _peak_rss():
+    """Return the peak RSS of this process in bytes"""
+    return resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss * pipelines.MAX_RSS_FACTOR
+
+
+def _commands(stages, volume):
+    """Return the list of commands sending volume bytes
+    from /dev/zero through the given number of cat stages
+    """
+    commands = [['head', '-c', str(volume), '/dev/zero']]
+    commands.extend(['cat'] for unused_stage in range(stages))
+    return commands
+
+
+def run_once(implementation, stages, volume):
+    """Run the pipeline once using the given implementation
+    and return the number of output bytes
+    """
+    commands = _commands(stages, volume)
+    if implementation == SHELL:
+        output = subprocess.run(
+            ['/bin/sh', '-c', ' | '.join(
+                ' '.join(command) for command in commands)],
+            stdout=subprocess.PIPE,
+            check=True).stdout
+    elif implementation == PIPELINE:
+        output = pipelines.ProcessPipeline(
+            *commands, check=True).result.stdout
+    else:
+        output = pipelines.ProcessChain(
+            *commands,
+            check=True,
+            keep_intermediate_results=False).result.stdout
+    #
+    return len(output)
+
+
+def spawn_latency(implementation, repetitions):
+    """Return the mean and minimum latency in seconds
+    of running a single trivial command
+    """
+    timings = []
+    for unused_repetition in range(repetitions):
+        start_time = time.perf_counter()
+        if implementation == SHELL:
+            subprocess.run(['/bin/sh', '-c', 'true'], check=True)
+        elif implementation == PIPELINE:
+            pipelines.ProcessPipeline(['true'], check=True)
+        else:
+            pipelines.ProcessChain(['true'], check=True)
+        #
+        timings.append(time.perf_counter() - start_time)
+    #
+    return (sum(timings) / len(timings), min(timings))
+
+
+def measure(implementation, stages, volume, repetitions):
+    """Return a dict with the best throughput in MiB/s
+    and the peak RSS of this process
+    """
+    best_time = None
+    for unused_repetition in range(repetitions):
+        start_time = time.perf_counter()
+        output_size = run_once(implementation, stages, volume)
+        elapsed_time = time.perf_counter() - start_time
+        if output_size != volume:
+            raise ValueError(
+                'Unexpected output size: {0}'.format(output_size))
+        #
+        if best_time is None or elapsed_time < best_time:
+            best_time = elapsed_time
+        #
+    #
+    return dict(
+        implementation=implementation,
+        stages=stages,
+        volume_mib=volume / MEBIBYTE,
+        mib_per_second=volume / MEBIBYTE / best_time,
+        best_seconds=best_time,
+        peak_parent_rss=_peak_rss())
+
+
+def measure_in_worker(implementation, stages, volume, repetitions):
+    """Run measure() in a fresh Python interpreter
+    and return its result
+    """
+    worker = pipelines.ProcessPipeline(
+        [sys.executable,
+         os.path.abspath(__file__),
+         WORKER_OPTION,
+         implementation,
+         str(stages),
+         str(volume),
+         str(repetitions)],
+        check=True)
+    return json.loads(worker.result.stdout.decode())
+
+
+def main(arguments=None):
+    """Run the benchmark"""
+    if arguments is None:
+        arguments = sys.argv[1:]
+    #
+    if arguments and arguments[0] == WORKER_OPTION:
+        implementation, stages, volume, repetitions = arguments[1:]
+        json.dump(
+            measure(implementation,
+                    int(stages),
+                    int(volume),
+                    int(repetitions)),
+            sys.stdout)
+        return 0
+    #
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip())
+    argument_parser.add_argument(
+        '--stages',
+        type=int,
+        nargs='+',
+        default=list(range(1, 9)),
+        help='Numbers of cat stages (default: %(default)s)')
+    argument_parser.add_argument(
+        '--volumes',
+        type=int,
+        nargs='+',
+        default=[1, 16, 128],
+        help='Data volumes in MiB (default: %(default)s)')
+    argument_parser.add_argument(
+        '--repetitions',
+        type=int,
+        default=3,
+        help='Runs per throughput measurement, the best is reported'
+        ' (default: %(default)s)')
+    argument_parser.add_argument(
+        '--spawn-repetitions',
+        type=int,
+        default=200,
+        help='Spawns per latency measurement (default: %(default)s)')
+    argument_parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Print machine-readable JSON output')
+    argument_parser.add_argument(
+        '--output',
+        metavar='PATH',
+        help='Also write the JSON output to PATH, e.g. for comparing'
+        ' the results of different releases')
+    options = argument_parser.parse_args(arguments)
+    report = dict(
+        smallparts_version=smallparts.__version__,
+        python_version=platform.python_version(),
+        platform=platform.platform(),
+        timestamp=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        spawn_latency=[],
+        throughput=[])
+    for implementation in IMPLEMENTATIONS:
+        mean, minimum = spawn_latency(
+            implementation, options.spawn_repetitions)
+        report['spawn_latency'].append(
+            dict(implementation=implementation,
+                 mean_seconds=mean,
+                 min_seconds=minimum))
+    #
+    for volume in options.volumes:
+        for stages in options.stages:
+            for implementation in IMPLEMENTATIONS:
+                report['throughput'].append(
+                    measure_in_worker(
+                        implementation,
+                        stages,
+                        volume * MEBIBYTE,
+                        options.repetitions))
+            #
+        #
+    #
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as output_file:
+            json.dump(report, output_file, indent=2)
+        #
+    #
+    if options.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return 0
+    #
+    print('{0:>10} {1:>12} {2:>12}'.format(
+        'spawn', 'mean (µs)', 'min (µs)'))
+    for record in report['spawn_latency']:
+        print('{0:>10} {1:>12.1f} {2:>12.1f}'.format(
+            record['implementation'],
+            record['mean_seconds'] * 1e6,
+            record['min_seconds'] * 1e6))
+    #
+    print()
+    print('{0:>10} {1:>8} {2:>12} {3:>12} {4:>16}'.format(
+        'throughput', 'stages', 'volume (MiB)', 'MiB/s', 'peak RSS (MiB)'))
+    for record in report['throughput']:
+        print('{0:>10} {1:>8} {2:>12.0f} {3:>12.1f} {4:>16.1f}'.format(
+            record['implementation'],
+            record['stages'],
+            record['volume_mib'],
+            record['mib_per_second'],
+            record['peak_parent_rss'] / MEBIBYTE))
+    #
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim:fileencoding=utf-8 autoindent ts=4 sw=4 sts=4 expandtab:
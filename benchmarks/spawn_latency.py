@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+spawn_latency - benchmark process spawn latency
+of smallparts.pipelines against the parent process RSS,
+comparing subprocess.Popen (fork and exec) with os.posix_spawnp()
+
+"""
+
+
+import argparse
+import json
+import resource
+import sys
+import time
+
+from smallparts import pipelines
+
+
+MEBIBYTE = 1024 * 1024
+PAGE_SIZE = resource.getpagesize()
+
+
+def _current_rss():
+    """Return the current RSS of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * PAGE_SIZE
+        #
+    except OSError:
+        return resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss * pipelines.MAX_RSS_FACTOR
+    #
+
+
+def _touched_buffer(size):
+    """Return a bytearray of the given size
+    with every page touched so it counts towards the RSS
+    """
+    buffer = bytearray(size)
+    for offset in range(0, size, PAGE_SIZE):
+        buffer[offset] = 1
+    #
+    return buffer
+
+
+def measure(use_posix_spawn, repetitions):
+    """Return the mean and minimum latency in seconds
+    of running a single trivial command
+    """
+    timings = []
+    for unused_repetition in range(repetitions):
+        start_time = time.perf_counter()
+        pipelines.ProcessPipeline(
+            ['true'],
+            stdout=pipelines.DEVNULL,
+            stderr=pipelines.DEVNULL,
+            use_posix_spawn=use_posix_spawn)
+        timings.append(time.perf_counter() - start_time)
+    #
+    return (sum(timings) / len(timings), min(timings))
+
+
+def main(arguments=None):
+    """Run the benchmark"""
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip())
+    argument_parser.add_argument(
+        '--sizes',
+        type=int,
+        nargs='+',
+        default=[0, 256, 1024, 4096],
+        help='Additional parent memory in MiB (default: %(default)s)')
+    argument_parser.add_argument(
+        '--repetitions',
+        type=int,
+        default=200,
+        help='Spawns per measurement (default: %(default)s)')
+    argument_parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Print machine-readable JSON output')
+    options = argument_parser.parse_args(arguments)
+    measurements = []
+    for size in options.sizes:
+        ballast = _touched_buffer(size * MEBIBYTE)
+        parent_rss = _current_rss()
+        for (launcher, use_posix_spawn) in (
+                ('popen', False), ('posix_spawn', True)):
+            mean, minimum = measure(use_posix_spawn, options.repetitions)
+            measurements.append(
+                dict(launcher=launcher,
+                     parent_rss=parent_rss,
+                     mean_seconds=mean,
+                     min_seconds=minimum))
+        #
+        del ballast
+    #
+    if options.json:
+        json.dump(measurements, sys.stdout, indent=2)
+        print()
+        return 0
+    #
+    print('{0:>14} {1:>12} {2:>12} {3:>12}'.format(
+        'parent RSS', 'launcher', 'mean (µs)', 'min (µs)'))
+    for record in measurements:
+        print('{0:>10} MiB {1:>12} {2:>12.1f} {3:>12.1f}'.format(
+            record['parent_rss'] // MEBIBYTE,
+            record['launcher'],
+            record['mean_seconds'] * 1e6,
+            record['min_seconds'] * 1e6))
+    #
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim:fileencoding=utf-8 autoindent ts=4 sw=4 sts=4 expandtab:
@@ -9,11 +9,44 @@ Command line interface (subprocess) pipelines wrapper
 """
 
 
+import asyncio
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
+import locale
+import os
+import re
+import selectors
 import shlex
+import shutil
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import warnings
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+#
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+#
 
 from smallparts import namespaces
+from smallparts.text import templates
+from smallparts.text import transcode
 
 
 # "Proxy" subprocess constants
@@ -22,6 +55,41 @@ DEVNULL = subprocess.DEVNULL
 PIPE = subprocess.PIPE
 STDOUT = subprocess.STDOUT
 
+# fcntl command for setting the pipe buffer size
+# (Linux only, defined in the fcntl module since Python 3.10)
+if sys.platform.startswith('linux') and fcntl:
+    _F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+else:
+    _F_SETPIPE_SZ = None
+#
+
+# Default chunk size for streamed output
+DEFAULT_CHUNK_SIZE = 65536
+
+# Default block size for ParallelStage (1 MiB)
+DEFAULT_BLOCK_SIZE = 1048576
+
+# Default maximum size of a ResultCache (256 MiB)
+DEFAULT_CACHE_SIZE = 268435456
+
+# Default time in seconds between SIGTERM and SIGKILL on cancellation
+DEFAULT_GRACE_PERIOD = 2
+
+# Parts of the output retained if it exceeds the limit
+HEAD = 'head'
+TAIL = 'tail'
+HEAD_AND_TAIL = 'head and tail'
+
+# Compression methods for captured output
+ZLIB = 'zlib'
+LZMA = 'lzma'
+
+# Up to three UTF-8 continuation bytes at the start of truncated output
+_PRX_UTF8_CONTINUATION = re.compile(b'[\x80-\xbf]{0,3}')
+
+# Factor for converting ru_maxrss values to bytes
+MAX_RSS_FACTOR = 1 if sys.platform == 'darwin' else 1024
+
 
 #
 # Exceptions
@@ -36,301 +104,3315 @@ class IllegalStateException(Exception):
 
 
 #
-# Classes
+# Helper functions
 #
 
 
-class _AbstractPipeline():
+def _is_text_mode(process_arguments):
+    """Return True if the process arguments specify text mode"""
+    return bool(process_arguments.get('encoding')
+                or process_arguments.get('errors')
+                or process_arguments.get('universal_newlines'))
 
-    """Wrapper for a subprocess.Popen() object
-    also storing the result
 
-    Supports keyword arguments for the subprocess.Popen() objects as defined in
-    https://docs.python.org/3.6/library/subprocess.html#popen-constructor
-    with the exception of the deprecated preexec_fn argument.
-    Default values are the same as documented there, except stderr and stdout
-    (both defaulting to subprocess.PIPE).
+def _strip_partial_utf8(data, at_start=False, at_end=False):
+    """Return data with a partial UTF-8 sequence at the start
+    and/or at the end replaced by U+FFFD (encoded as UTF-8)
+    if the remaining data is valid UTF-8, else return data unchanged
+    """
+    start = _PRX_UTF8_CONTINUATION.match(data).end() if at_start else 0
+    try:
+        end = start + codecs.utf_8_decode(
+            data[start:], 'strict', not at_end)[1]
+    except UnicodeDecodeError:
+        return data
+    #
+    replacement = '\N{REPLACEMENT CHARACTER}'.encode('utf-8')
+    return b''.join((replacement if start else b'',
+                     data[start:end],
+                     replacement if end < len(data) else b''))
 
-    Additional keyword arguments:
-        run_immediately (default: False)
-        intermediate_stderr (default: None)
-        input (default: None)
-        timeout (default: None)
+
+def _split_chunks(chunks, separator, keep_separator=True):
+    """Generator function re-splitting an iterable of chunks
+    into records terminated by separator
+    (which is kept unless keep_separator is False)
     """
+    pending = None
+    for chunk in chunks:
+        if pending:
+            chunk = pending + chunk
+        #
+        records = chunk.split(separator)
+        pending = records.pop()
+        for record in records:
+            if keep_separator:
+                record += separator
+            #
+            yield record
+        #
+    #
+    if pending:
+        yield pending
+    #
 
-    defaults = dict(
-        bufsize=-1,
-        executable=None,
-        stdin=None,
-        stdout=PIPE,
-        stderr=PIPE,
-        close_fds=True,
-        shell=False,
-        cwd=None,
-        env=None,
-        universal_newlines=False,
-        startupinfo=None,
-        creationflags=0,
-        restore_signals=True,
-        start_new_session=False,
-        pass_fds=(),
-        encoding=None,
-        errors=None)
-    states = namespaces.Namespace(
-        ready=0,
-        running=1,
-        finished=2)
-    supported_intermediate_stderr = (None, DEVNULL, STDOUT)
 
-    def __init__(self, *commands, **kwargs):
-        """Prepare subprocess(es)"""
-        # Store arguments for the .repeat() method
-        self.__repeatable = namespaces.Namespace(
-            commands=commands,
-            kwargs=kwargs.copy())
-        # Build the actual commands list from the provided
-        # (non-keyword) arguments
-        self.commands = []
-        for single_command in commands:
-            if isinstance(single_command, str):
-                appendable_command = shlex.split(single_command)
-            else:
-                try:
-                    appendable_command = list(single_command)
-                except TypeError as type_error:
-                    raise ValueError(
-                        'Invalid command: {0!r}'.format(
-                            single_command)) from type_error
+def _write_input(stream, input_data):
+    """Write input_data to stream and close it,
+    ignoring a broken pipe.
+    input_data may be None (no input), bytes (or str in text mode),
+    a file object or an iterable of chunks.
+    The stream is closed even if writing fails.
+    """
+    try:
+        if input_data is None:
+            pass
+        elif isinstance(input_data, (bytes, bytearray, memoryview, str)):
+            stream.write(input_data)
+        elif hasattr(input_data, 'read'):
+            while True:
+                chunk = input_data.read(DEFAULT_CHUNK_SIZE)
+                if not chunk:
+                    break
                 #
+                stream.write(chunk)
             #
-            if appendable_command:
-                self.commands.append(appendable_command)
+        else:
+            for chunk in input_data:
+                stream.write(chunk)
             #
         #
-        if not self.commands:
-            raise ValueError('Please provide at least one command.')
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
         #
-        check = kwargs.pop('check', False)
-        execute_immediately = kwargs.pop('execute_immediately', True)
-        input_ = kwargs.pop('input', None)
-        intermediate_stderr = kwargs.pop('intermediate_stderr', None)
-        if intermediate_stderr not in self.supported_intermediate_stderr:
-            warnings.warn(
-                'Supported values for intermediate_stderr:'
-                ' None, DEVNULL or STDOUT. {0!r} has been ignored and'
-                ' substituted by None.'.format(intermediate_stderr))
-            intermediate_stderr = None
+    #
+
+
+def _returncode_from_status(status):
+    """Return a subprocess.Popen compatible return code
+    from a wait status
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    #
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    #
+    return status
+
+
+def _posix_spawn_possible(process_arguments):
+    """Return True if a process with the given subprocess.Popen
+    arguments can be started using os.posix_spawn()
+    """
+    if not hasattr(os, 'posix_spawnp'):
+        return False
+    #
+    return not (process_arguments['shell']
+                or process_arguments['cwd'] is not None
+                or process_arguments['pass_fds']
+                or _is_text_mode(process_arguments))
+
+
+def _input_digest(input_, stdin):
+    """Return a hex digest of the input of a process for the
+    ResultCache, or None if it cannot be determined
+    without consuming the input (including the standard input
+    inherited from the parent process if stdin is None)
+    """
+    digest = hashlib.sha256()
+    if input_ is not None:
+        if not isinstance(input_, (bytes, str)):
+            # Streamed input (file object or iterable)
+            return None
         #
-        timeout = kwargs.pop('timeout', None)
-        self.call_arguments = namespaces.Namespace(
-            check=check,
-            input=input_,
-            intermediate_stderr=intermediate_stderr,
-            timeout=timeout)
+        if isinstance(input_, str):
+            input_ = input_.encode('utf-8', 'surrogatepass')
         #
-        if input_:
-            kwargs['stdin'] = PIPE
-        else:
-            kwargs['stdin'] = None
+        digest.update(input_)
+    elif stdin is None:
+        return None
+    elif stdin != DEVNULL:
+        # Hash the contents of a seekable file and rewind it
+        try:
+            position = stdin.tell()
+        except (AttributeError, OSError, ValueError):
+            return None
         #
-        self.current_state = self.states.ready
-        self.process_arguments = dict(self.defaults)
-        self.process_arguments.update(kwargs)
-        self.result = None
-        if execute_immediately:
-            self.execute()
+        try:
+            while True:
+                chunk = stdin.read(DEFAULT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                #
+                digest.update(chunk)
+            #
+        except (OSError, TypeError, ValueError):
+            return None
+        finally:
+            stdin.seek(position)
         #
+    #
+    return digest.hexdigest()
 
-    def repeat(self):
-        """Create an instance with the same parameters as the current one"""
-        return self.__class__(*self.__repeatable.commands,
-                              **self.__repeatable.kwargs)
 
-    def _execution_implementation(self):
-        """Override this method in child classes with the implementation
-        of the pipeline call: Start the subprocess(es) and set the result
-        """
-        raise NotImplementedError
+def _command_display(command):
+    """Return a display string for the command"""
+    if callable(command):
+        return repr(command)
+    #
+    return ' '.join(
+        shlex.quote(os.fsdecode(argument)) for argument in command)
 
-    def execute(self, **kwargs):
-        """Check if self.state is ready, set self.state to running
-        or raise an exception.
-        Update self.call_arguments from the keyword arguments
-        check, input, and timeout (each if provided)
-        Execute the concrete implementation of
-        """
-        if self.current_state != self.states.ready:
-            raise IllegalStateException('Please create a new instance'
-                                        ' using the .repeat() method!')
+
+def _stats_record(process):
+    """Return a namespace with the resource usage
+    of a (finished) process started as _AccountingPopen instance.
+    On Linux, ru_maxrss includes the high-water mark
+    the child inherited from this process before exec.
+    """
+    try:
+        wall_time = process.end_time - process.start_time
+    except TypeError:
+        wall_time = None
+    #
+    resource_usage = process.resource_usage
+    if resource_usage is None:
+        user_time = system_time = max_rss = None
+    else:
+        user_time = resource_usage.ru_utime
+        system_time = resource_usage.ru_stime
+        max_rss = resource_usage.ru_maxrss * MAX_RSS_FACTOR
+    #
+    return namespaces.Namespace(
+        args=process.args,
+        returncode=process.returncode,
+        wall_time=wall_time,
+        user_time=user_time,
+        system_time=system_time,
+        max_rss=max_rss)
+
+
+def _kill_async_process(process, process_group=False):
+    """Kill an asyncio subprocess if it is still running,
+    or the whole process group led by it if process_group is True
+    """
+    if process_group:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
         #
-        self.current_state = self.states.running
-        for item in ('check', 'input', 'timeout'):
+    elif process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        #
+    #
+
+
+#
+# Classes
+#
+
+
+class _AccountingPopen(subprocess.Popen):
+
+    """subprocess.Popen subclass reaping the process using os.wait4()
+    (where available) and recording start time, end time
+    and resource usage
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Record the start time"""
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.resource_usage = None
+        super().__init__(*args, **kwargs)
+
+    def _try_wait(self, wait_flags):
+        """Override the internal subprocess.Popen method
+        waiting for the process, see
+        https://github.com/python/cpython/blob/3.6/Lib/subprocess.py#L1398
+        """
+        try:
+            wait4 = os.wait4
+        except AttributeError:
+            (pid, status) = super()._try_wait(wait_flags)
+            resource_usage = None
+        else:
             try:
-                self.call_arguments[item] = kwargs[item]
-            except KeyError:
-                continue
+                (pid, status, resource_usage) = wait4(self.pid, wait_flags)
+            except ChildProcessError:
+                # The child is dead, we can't get the status
+                return (self.pid, 0)
             #
         #
-        self._execution_implementation()
+        if pid == self.pid:
+            self.end_time = time.monotonic()
+            self.resource_usage = resource_usage
+        #
+        return (pid, status)
 
-    @classmethod
-    def run(cls, *commands, **kwargs):
-        """Create an instance, run it immediately and return its result"""
-        kwargs['execute_immediately'] = True
-        pipeline = cls(*commands, **kwargs)
-        return pipeline.result
 
+class _CallableStage():
 
-class ProcessChain(_AbstractPipeline):
+    """subprocess.Popen lookalike running a Python callable
+    in a thread, connected to OS pipes or files.
 
-    """Pseudo pipeline using sequential subprocesses with subprocess.run()
+    The callable is called with a binary file object (iterable over lines)
+    as the only argument. It must return an iterable of bytes
+    (e.g. a generator) which is written to the output, or None.
+    Its return code is 0 on success, 1 if an exception occurred
+    (which is stored in the exception attribute),
+    or the negative signal number like a process terminated
+    by SIGPIPE or SIGKILL.
     """
 
-    def __init__(self, *commands, **kwargs):
-        """Initialize the super class"""
-        self.all_results = []
-        super().__init__(*commands, **kwargs)
+    def __init__(self, function, stdin=None, stdout=None):
+        """Open the input and output files and start the thread"""
+        self.args = function
+        self.pid = None
+        self.returncode = None
+        self.exception = None
+        self.stdin = self.stdout = self.stderr = None
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.resource_usage = None
+        self.__killed = False
+        input_file = self.__open_input(stdin)
+        try:
+            output_file = self.__open_output(stdout)
+        except BaseException:
+            input_file.close()
+            raise
+        #
+        self.__thread = threading.Thread(
+            target=self.__run,
+            args=(input_file, output_file),
+            daemon=True)
+        self.__thread.start()
 
-    def _execution_implementation(self):
-        """Start the subprocess(es) and set the result"""
-        self.all_results.clear()
-        last_command_index = len(self.commands) - 1
-        for current_index, current_command in enumerate(self.commands):
-            current_arguments = namespaces.Namespace(self.process_arguments)
-            if current_index > 0:
-                current_input = self.all_results[current_index - 1].stdout
-            else:
-                current_input = self.call_arguments.input
-            #
-            if current_index < last_command_index:
-                current_arguments.stdout = PIPE
-                current_arguments.stderr = \
-                    self.call_arguments.intermediate_stderr
+    def __open_input(self, stdin):
+        """Return the file to read from"""
+        if stdin == PIPE:
+            read_fd, write_fd = os.pipe()
+            self.stdin = open(write_fd, 'wb')
+            return open(read_fd, 'rb')
+        #
+        if stdin in (None, DEVNULL):
+            return open(os.devnull, 'rb')
+        #
+        if not isinstance(stdin, int):
+            stdin = stdin.fileno()
+        #
+        return open(os.dup(stdin), 'rb')
+
+    def __open_output(self, stdout):
+        """Return the file to write to"""
+        if stdout == PIPE:
+            read_fd, write_fd = os.pipe()
+            self.stdout = open(read_fd, 'rb')
+            return open(write_fd, 'wb')
+        #
+        if stdout == DEVNULL:
+            return open(os.devnull, 'wb')
+        #
+        if stdout is None:
+            stdout = 1
+        elif not isinstance(stdout, int):
+            stdout = stdout.fileno()
+        #
+        return open(os.dup(stdout), 'wb')
+
+    def __run(self, input_file, output_file):
+        """Thread target: call the function and write its output"""
+        returncode = 0
+        try:
+            with input_file, output_file:
+                for chunk in self.args(input_file) or ():
+                    if self.__killed:
+                        returncode = -signal.SIGKILL
+                        break
+                    #
+                    output_file.write(chunk)
+                #
             #
-            self.all_results.append(
-                subprocess.run(
-                    current_command,
-                    input=current_input,
-                    check=self.call_arguments.check,
-                    timeout=self.call_arguments.timeout,
-                    bufsize=current_arguments.bufsize,
-                    executable=current_arguments.executable,
-                    stdout=current_arguments.stdout,
-                    stderr=current_arguments.stderr,
-                    close_fds=current_arguments.close_fds,
-                    shell=current_arguments.shell,
-                    cwd=current_arguments.cwd,
-                    env=current_arguments.env,
-                    universal_newlines=current_arguments.universal_newlines,
-                    startupinfo=current_arguments.startupinfo,
-                    creationflags=current_arguments.creationflags,
-                    restore_signals=current_arguments.restore_signals,
-                    start_new_session=current_arguments.start_new_session,
-                    pass_fds=current_arguments.pass_fds,
-                    encoding=current_arguments.encoding,
-                    errors=current_arguments.errors))
-            #
-        #
-        self.current_state = self.states.finished
-        self.result = self.all_results[last_command_index]
+        except BrokenPipeError:
+            returncode = -signal.SIGPIPE
+        except Exception as error:
+            self.exception = error
+            returncode = 1
+        #
+        self.end_time = time.monotonic()
+        self.returncode = returncode
 
+    def kill(self):
+        """Stop writing output as soon as possible.
+        The reading end (self.stdout) is left alone
+        because it may be in use by another thread,
+        a pending write is unblocked when its owner closes it.
+        """
+        self.__killed = True
 
-class ProcessPipeline(_AbstractPipeline):
+    terminate = kill
 
-    """Pipeline using parallel subprocesses as described in
-    https://docs.python.org/3/library/subprocess.html#replacing-shell-pipeline
+    def send_signal(self, unused_signal_number):
+        """Any signal stops the callable like kill()"""
+        self.kill()
+
+    def poll(self):
+        """Return the return code (None if still running)"""
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Wait for the thread and return the return code"""
+        self.__thread.join(timeout)
+        if self.__thread.is_alive():
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        #
+        return self.returncode
+
+
+class _SpawnedProcess():
+
+    """subprocess.Popen lookalike for a process started using
+    os.posix_spawnp(), avoiding the fork() of the (possibly large)
+    parent process. Supports only the subprocess.Popen arguments
+    accepted by _posix_spawn_possible().
+    The process is reaped using os.wait4(), recording the same
+    additional attributes as _AccountingPopen.
     """
 
-    def _execution_implementation(self):
-        """Start the subprocess(es) and set the result"""
-        processes = []
-        last_command_index = len(self.commands) - 1
-        if last_command_index > 0:
-            # We communicate() only with the last process in the pipeline.
-            # If there is more than one process, input is ignored,
-            # and a warning is issued.
-            if self.call_arguments.input is not None:
-                warnings.warn(
-                    'Input {0.call_arguments.input!r} has been ignored.'
-                    ' Use the ProcessChain class to avoid this.'.format(self))
-            self.call_arguments.input = None
-            self.process_arguments['stdin'] = None
-        #
-        for current_index, current_command in enumerate(self.commands):
-            current_arguments = namespaces.Namespace(self.process_arguments)
-            if current_index > 0:
-                current_arguments.stdin = processes[current_index - 1].stdout
-            #
-            if current_index < last_command_index:
-                current_arguments.stdout = PIPE
-                current_arguments.stderr = \
-                    self.call_arguments.intermediate_stderr
+    # subprocess.Popen restores these signals if restore_signals is True
+    restored_signals = tuple(
+        getattr(signal, name) for name in ('SIGPIPE', 'SIGXFZ', 'SIGXFSZ')
+        if hasattr(signal, name))
+
+    def __init__(self, args, executable=None, stdin=None, stdout=None,
+                 stderr=None, env=None, restore_signals=True,
+                 start_new_session=False, **unused_kwargs):
+        """Start the process"""
+        self.args = args
+        self.returncode = None
+        self.stdin = self.stdout = self.stderr = None
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.resource_usage = None
+        self.__waitpid_lock = threading.Lock()
+        file_actions = []
+        child_fds = []
+        try:
+            for (target_fd, source, mode) in (
+                    (0, stdin, 'wb'), (1, stdout, 'rb'), (2, stderr, 'rb')):
+                if source is None:
+                    continue
+                #
+                if source == PIPE:
+                    read_fd, write_fd = os.pipe()
+                    if target_fd:
+                        parent_fd, source = read_fd, write_fd
+                    else:
+                        source, parent_fd = read_fd, write_fd
+                    #
+                    child_fds.append(source)
+                    setattr(self,
+                            ('stdin', 'stdout', 'stderr')[target_fd],
+                            open(parent_fd, mode))
+                elif source == DEVNULL:
+                    source = os.open(os.devnull, os.O_RDWR)
+                    child_fds.append(source)
+                elif source == STDOUT:
+                    source = 1
+                elif not isinstance(source, int):
+                    source = source.fileno()
+                #
+                file_actions.append((os.POSIX_SPAWN_DUP2, source, target_fd))
+            #
+            if restore_signals:
+                signals_default = self.restored_signals
+            else:
+                signals_default = ()
             #
+            self.pid = os.posix_spawnp(
+                executable or args[0],
+                args,
+                os.environ if env is None else env,
+                file_actions=file_actions,
+                setsigdef=signals_default,
+                setsid=start_new_session)
+        except BaseException:
+            for stream in (self.stdin, self.stdout, self.stderr):
+                if stream:
+                    stream.close()
+                #
+            #
+            raise
+        finally:
+            for child_fd in child_fds:
+                os.close(child_fd)
+            #
+        #
+
+    def __try_wait(self, wait_flags):
+        """Wait for the process using os.wait4()
+        and set the return code if it has finished
+        """
+        (pid, status, resource_usage) = os.wait4(self.pid, wait_flags)
+        if pid == self.pid:
+            self.end_time = time.monotonic()
+            self.resource_usage = resource_usage
+            self.returncode = _returncode_from_status(status)
+        #
+
+    def poll(self):
+        """Return the return code (None if still running)"""
+        if self.returncode is None and self.__waitpid_lock.acquire(False):
             try:
-                current_process = subprocess.Popen(
-                    current_command,
-                    bufsize=current_arguments.bufsize,
-                    executable=current_arguments.executable,
-                    stdin=current_arguments.stdin,
-                    stdout=current_arguments.stdout,
-                    stderr=current_arguments.stderr,
-                    close_fds=current_arguments.close_fds,
-                    shell=current_arguments.shell,
-                    cwd=current_arguments.cwd,
-                    env=current_arguments.env,
-                    universal_newlines=current_arguments.universal_newlines,
-                    startupinfo=current_arguments.startupinfo,
-                    creationflags=current_arguments.creationflags,
-                    restore_signals=current_arguments.restore_signals,
-                    start_new_session=current_arguments.start_new_session,
-                    pass_fds=current_arguments.pass_fds,
-                    encoding=current_arguments.encoding,
-                    errors=current_arguments.errors)
-            except (OSError, ValueError):
-                self.current_state = self.states.finished
-                raise
+                if self.returncode is None:
+                    self.__try_wait(os.WNOHANG)
+                #
+            finally:
+                self.__waitpid_lock.release()
             #
-            processes.append(current_process)
         #
-        # Close stdout to allow processes to receive SIGPIPE.
-        for current_index in range(last_command_index):
-            processes[current_index].stdout.close()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Wait for the process and return the return code"""
+        if timeout is None:
+            with self.__waitpid_lock:
+                if self.returncode is None:
+                    self.__try_wait(0)
+                #
+            #
+            return self.returncode
         #
-        # Communicate with the last process in the pipeline.
-        # Mimick subprocess.run() behaviour as in
-        # https://github.com/python/cpython/blob/3.6/Lib/subprocess.py#L424
-        last_process = processes[last_command_index]
-        try:
-            stdout, stderr = last_process.communicate(
-                input=self.call_arguments.input,
-                timeout=self.call_arguments.timeout)
-        except subprocess.TimeoutExpired as timeout_expired:
-            last_process.kill()
-            stdout, stderr = last_process.communicate()
-            raise subprocess.TimeoutExpired(
-                last_process.args,
-                self.call_arguments.timeout,
-                output=stdout,
-                stderr=stderr) from timeout_expired
+        # Polling loop as in subprocess.Popen
+        deadline = time.monotonic() + timeout
+        delay = 0.0005
+        while self.poll() is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            #
+            delay = min(delay * 2, remaining, 0.05)
+            time.sleep(delay)
         #
-        returncode = last_process.poll()
-        if self.call_arguments.check and returncode:
-            raise subprocess.CalledProcessError(
-                returncode,
-                last_process.args,
-                output=stdout,
-                stderr=stderr)
-        #
-        self.result = subprocess.CompletedProcess(
-            last_process.args,
-            returncode,
-            stdout=stdout,
-            stderr=stderr)
-        # processes cleanup; avoid ResourceWarnings
-        for current_index in range(last_command_index):
-            processes[current_index].wait()
+        return self.returncode
+
+    def send_signal(self, signal_number):
+        """Send a signal to the process if it is still running"""
+        if self.poll() is None:
+            try:
+                os.kill(self.pid, signal_number)
+            except ProcessLookupError:
+                pass
+            #
+        #
+
+    def kill(self):
+        """Kill the process"""
+        self.send_signal(signal.SIGKILL)
+
+    def terminate(self):
+        """Terminate the process"""
+        self.send_signal(signal.SIGTERM)
+
+
+class _OutputCapture():
+
+    """Collector for output chunks, keeping at most max_bytes:
+    the head, the tail (in a ring buffer of chunks)
+    or both halves, depending on retain
+    """
+
+    def __init__(self, max_bytes=None, retain=TAIL):
+        """Set the limits"""
+        self.total_bytes = 0
+        self.__head = []
+        self.__head_size = 0
+        self.__tail = collections.deque()
+        self.__tail_size = 0
+        if max_bytes is None:
+            self.__head_limit = None
+            self.__tail_limit = 0
+        elif retain == HEAD:
+            self.__head_limit = max_bytes
+            self.__tail_limit = 0
+        elif retain == TAIL:
+            self.__head_limit = 0
+            self.__tail_limit = max_bytes
+        else:
+            self.__head_limit = max_bytes // 2
+            self.__tail_limit = max_bytes - self.__head_limit
+        #
+
+    @property
+    def truncated(self):
+        """True if output has been dropped"""
+        return self.total_bytes > self.__head_size + self.__tail_size
+
+    def append(self, data):
+        """Add data, dropping everything exceeding the limits"""
+        self.total_bytes += len(data)
+        if self.__head_limit is None:
+            self.__head.append(data)
+            self.__head_size += len(data)
+            return
+        #
+        if self.__head_size < self.__head_limit:
+            head_part = data[:self.__head_limit - self.__head_size]
+            self.__head.append(head_part)
+            self.__head_size += len(head_part)
+            data = data[len(head_part):]
+        #
+        if not data or not self.__tail_limit:
+            return
+        #
+        self.__tail.append(data)
+        self.__tail_size += len(data)
+        while self.__tail_size > self.__tail_limit:
+            excess = self.__tail_size - self.__tail_limit
+            if len(self.__tail[0]) <= excess:
+                self.__tail_size -= len(self.__tail.popleft())
+            else:
+                self.__tail[0] = self.__tail[0][excess:]
+                self.__tail_size -= excess
+            #
+        #
+
+    def parts(self):
+        """Return the retained head and tail as a tuple of bytes"""
+        return (b''.join(self.__head), b''.join(self.__tail))
+
+    def getvalue(self):
+        """Return the retained output as bytes"""
+        return b''.join(self.parts())
+
+
+class _CompressedCapture():
+
+    """Collector for output chunks, compressing them on the fly
+    using zlib or lzma (method)
+    """
+
+    def __init__(self, method=ZLIB):
+        """Create the compressor"""
+        self.total_bytes = 0
+        self.truncated = False
+        if method == LZMA:
+            self.__compressor = lzma.LZMACompressor()
+            self.__decompress = lzma.decompress
+        else:
+            self.__compressor = zlib.compressobj()
+            self.__decompress = zlib.decompress
+        #
+        self.__chunks = []
+        self.__compressed_data = None
+
+    def append(self, data):
+        """Compress and add data"""
+        self.total_bytes += len(data)
+        compressed_chunk = self.__compressor.compress(data)
+        if compressed_chunk:
+            self.__chunks.append(compressed_chunk)
+        #
+
+    def compressed_value(self):
+        """Finish compression and return the compressed output.
+        No more data may be appended afterwards.
+        """
+        if self.__compressed_data is None:
+            self.__chunks.append(self.__compressor.flush())
+            self.__compressed_data = b''.join(self.__chunks)
+            self.__chunks = None
+            self.__compressor = None
+        #
+        return self.__compressed_data
+
+    @property
+    def compressed_bytes(self):
+        """Size of the compressed output"""
+        return len(self.compressed_value())
+
+    def getvalue(self):
+        """Return the decompressed output as bytes"""
+        return self.__decompress(self.compressed_value())
+
+
+class _OutputDecoder(io.IncrementalNewlineDecoder):
+
+    """Incremental decoder for text mode output,
+    translating newlines like subprocess.Popen does.
+    If detect_encoding is True, the encoding is detected
+    using a transcode.EncodingDetectingDecoder.
+    The encoding name is available in the encoding attribute.
+    errors overrides the error handling scheme
+    from the process arguments.
+    """
+
+    def __init__(self, process_arguments, detect_encoding=False,
+                 errors=None):
+        """Create the wrapped decoder"""
+        errors = errors or process_arguments.get('errors') or 'strict'
+        if detect_encoding:
+            self.__detector = transcode.EncodingDetectingDecoder(
+                errors=errors)
+            super().__init__(self.__detector, translate=True)
+            return
+        #
+        self.__detector = None
+        self.__encoding = process_arguments.get('encoding') \
+            or locale.getpreferredencoding(False)
+        super().__init__(
+            codecs.getincrementaldecoder(self.__encoding)(errors=errors),
+            translate=True)
+
+    @property
+    def encoding(self):
+        """The (detected) encoding name,
+        None if it has not been detected yet
+        """
+        if self.__detector:
+            return self.__detector.encoding
+        #
+        return self.__encoding
+
+
+class PipelineResult(subprocess.CompletedProcess):
+
+    """subprocess.CompletedProcess subclass with additional attributes
+    describing the captured output:
+        stdout_bytes, stderr_bytes: total number of bytes read
+            (None if the stream was not captured)
+        stdout_truncated, stderr_truncated: True if output was dropped
+            because of the max_output_bytes or max_error_bytes limit
+        stdout_encoding, stderr_encoding: name of the encoding
+            used for decoding the output (None if it was not decoded)
+        stdout_compressed_bytes, stderr_compressed_bytes: size of the
+            compressed output (None if it was not captured compressed)
+        exception: the exception raised by a Python callable command
+            (None otherwise)
+    Compressed output is decompressed on each access
+    to the stdout or stderr attribute.
+    """
+
+    def __init__(self, args, returncode, stdout=None, stderr=None,
+                 stdout_bytes=None, stderr_bytes=None,
+                 stdout_truncated=False, stderr_truncated=False,
+                 stdout_encoding=None, stderr_encoding=None,
+                 stdout_compressed_bytes=None, stderr_compressed_bytes=None,
+                 exception=None):
+        """Store the additional attributes"""
+        self.__values = {}
+        self.__loaders = {}
+        super().__init__(args, returncode, stdout=stdout, stderr=stderr)
+        self.stdout_bytes = stdout_bytes
+        self.stderr_bytes = stderr_bytes
+        self.stdout_truncated = stdout_truncated
+        self.stderr_truncated = stderr_truncated
+        self.stdout_encoding = stdout_encoding
+        self.stderr_encoding = stderr_encoding
+        self.stdout_compressed_bytes = stdout_compressed_bytes
+        self.stderr_compressed_bytes = stderr_compressed_bytes
+        self.exception = exception
+
+    def __get_output(self, stream_name):
+        """Return the output, loading it if required"""
+        try:
+            loader = self.__loaders[stream_name]
+        except KeyError:
+            return self.__values[stream_name]
+        #
+        value, encoding = loader()
+        setattr(self, '{0}_encoding'.format(stream_name), encoding)
+        return value
+
+    def __set_output(self, stream_name, value):
+        """Set the output, replacing a loader"""
+        self.__loaders.pop(stream_name, None)
+        self.__values[stream_name] = value
+
+    def set_output_loader(self, stream_name, loader):
+        """Set a function returning a tuple of the output
+        of stream_name ('stdout' or 'stderr') and its encoding name,
+        called on each access to the attribute
+        """
+        self.__values.pop(stream_name, None)
+        self.__loaders[stream_name] = loader
+
+    @property
+    def stdout(self):
+        """The captured standard output"""
+        return self.__get_output('stdout')
+
+    @stdout.setter
+    def stdout(self, value):
+        """Set the standard output"""
+        self.__set_output('stdout', value)
+
+    @property
+    def stderr(self):
+        """The captured standard error output"""
+        return self.__get_output('stderr')
+
+    @stderr.setter
+    def stderr(self, value):
+        """Set the standard error output"""
+        self.__set_output('stderr', value)
+
+
+class PipelineTracer():
+
+    """Collector for events from the pipelines it is passed to
+    (tracer argument), exporting them in the Chrome trace event format
+    for viewing a timeline in chrome://tracing or https://ui.perfetto.dev.
+    Each pipeline is displayed as a process, each command as a thread.
+    """
+
+    def __init__(self):
+        """Set the time origin"""
+        self.origin = time.monotonic()
+        self.__events = []
+        self.__lock = threading.Lock()
+        self.__last_pipeline_id = 0
+
+    def __timestamp(self, monotonic_time):
+        """Return the number of microseconds since the origin"""
+        return round((monotonic_time - self.origin) * 1000000, 3)
+
+    def __add(self, **event):
+        """Add an event"""
+        with self.__lock:
+            self.__events.append(event)
+        #
+
+    @property
+    def trace_events(self):
+        """Return a copy of the list of trace events"""
+        with self.__lock:
+            return list(self.__events)
+        #
+
+    def register_pipeline(self, name):
+        """Return a new pipeline id and add its name as metadata"""
+        with self.__lock:
+            self.__last_pipeline_id += 1
+            pipeline_id = self.__last_pipeline_id
+        #
+        self.__add(name='process_name', ph='M', pid=pipeline_id,
+                   args=dict(name=name))
+        return pipeline_id
+
+    def register_stage(self, pipeline_id, stage_index, name):
+        """Add the name of a pipeline stage as metadata"""
+        self.__add(name='thread_name', ph='M', pid=pipeline_id,
+                   tid=stage_index, args=dict(name=name))
+        self.__add(name='thread_sort_index', ph='M', pid=pipeline_id,
+                   tid=stage_index, args=dict(sort_index=stage_index))
+
+    def add_instant(self, name, pipeline_id, stage_index,
+                    monotonic_time=None, **args):
+        """Add an instant event (at the current time by default)"""
+        if monotonic_time is None:
+            monotonic_time = time.monotonic()
+        #
+        self.__add(name=name, cat='pipeline', ph='i', s='t',
+                   ts=self.__timestamp(monotonic_time),
+                   pid=pipeline_id, tid=stage_index, args=args)
+
+    def add_duration(self, name, pipeline_id, stage_index,
+                     start_time, end_time, **args):
+        """Add a complete event from start_time to end_time"""
+        self.__add(name=name, cat='pipeline', ph='X',
+                   ts=self.__timestamp(start_time),
+                   dur=round((end_time - start_time) * 1000000, 3),
+                   pid=pipeline_id, tid=stage_index, args=args)
+
+    def export(self, target):
+        """Write the trace in JSON format to target
+        (a path or a file object opened in text mode)
+        """
+        trace = dict(traceEvents=self.trace_events, displayTimeUnit='ms')
+        if isinstance(target, (str, bytes, os.PathLike)):
+            with open(target, 'w', encoding='utf-8') as trace_file:
+                json.dump(trace, trace_file)
+            #
+        else:
+            json.dump(trace, target)
+        #
+
+
+class PipelineFuture(concurrent.futures.Future):
+
+    """concurrent.futures.Future subclass for a pipeline
+    executed in the background, as returned by its start() method,
+    with additional methods similar to subprocess.Popen.
+
+    The future stays in the pending state while the pipeline is running,
+    so cancel() can kill the processes at any time before it has finished.
+    """
+
+    def __init__(self, pipeline):
+        """Store the pipeline"""
+        super().__init__()
+        self.pipeline = pipeline
+        self.__outcome_lock = threading.Lock()
+        self.__finished = threading.Event()
+
+    def running(self):
+        """Return True if the pipeline is still running"""
+        return not self.__finished.is_set()
+
+    def set_outcome(self, result, error=None):
+        """Set the result or the exception (unless cancelled),
+        called from the pipeline’s background thread
+        """
+        with self.__outcome_lock:
+            if not self.cancelled():
+                if error is None:
+                    self.set_result(result)
+                else:
+                    self.set_exception(error)
+                #
+            #
+        #
+        self.__finished.set()
+
+    def cancel(self):
+        """Cancel the future and kill the pipeline’s processes.
+        Return False if the pipeline has already finished.
+        """
+        with self.__outcome_lock:
+            if not super().cancel():
+                return False
+            #
+        #
+        # pylint: disable=protected-access ; same module
+        self.pipeline._kill_processes()
+        return True
+
+    def poll(self):
+        """Return None if the pipeline is still running,
+        else the last command’s return code
+        (None if the pipeline failed without a result)
+        """
+        if self.running() or self.pipeline.result is None:
+            return None
+        #
+        return self.pipeline.result.returncode
+
+    def wait(self, timeout=None):
+        """Wait until the pipeline has finished (also after cancel())
+        and return the last command’s return code as in poll().
+        Raise subprocess.TimeoutExpired if timeout expires first.
+        """
+        if not self.__finished.wait(timeout):
+            raise subprocess.TimeoutExpired(
+                self.pipeline.commands[-1], timeout)
+        #
+        return self.poll()
+
+
+class ResultCache():
+
+    """Content-addressed on-disk cache for the standard output
+    of ProcessChain stages.
+
+    Entries are keyed by the command, the executable,
+    the working directory, the environment (restricted to the
+    variables named in environment_keys if that is not None)
+    and a hash of the stage input.
+    If the total size of the cache exceeds max_size bytes,
+    the least recently used entries are evicted.
+    """
+
+    suffix = '.out'
+
+    def __init__(self, directory,
+                 max_size=DEFAULT_CACHE_SIZE,
+                 environment_keys=None):
+        """Create the cache directory if necessary"""
+        self.directory = os.fspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_size = max_size
+        if environment_keys is None:
+            self.environment_keys = None
+        else:
+            self.environment_keys = frozenset(environment_keys)
+        #
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__lock = threading.Lock()
+
+    def __entry_path(self, key):
+        """Return the path of the cache entry for key"""
+        return os.path.join(self.directory, key + self.suffix)
+
+    def __entries(self):
+        """Return a list of (modification time, size, path) tuples
+        for all existing cache entries
+        """
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(self.suffix):
+                continue
+            #
+            entry_path = os.path.join(self.directory, file_name)
+            try:
+                file_stat = os.stat(entry_path)
+            except FileNotFoundError:
+                continue
+            #
+            entries.append(
+                (file_stat.st_mtime_ns, file_stat.st_size, entry_path))
+        #
+        return entries
+
+    @property
+    def size(self):
+        """Total size of all cache entries in bytes"""
+        return sum(entry[1] for entry in self.__entries())
+
+    def key(self, command, process_arguments, input_digest):
+        """Return the cache key for the command
+        run with the process arguments and the input digest
+        """
+        environment = process_arguments['env']
+        if environment is None:
+            environment = os.environ
+        #
+        environment = sorted(
+            (os.fsdecode(name), os.fsdecode(value))
+            for (name, value) in environment.items()
+            if self.environment_keys is None
+            or os.fsdecode(name) in self.environment_keys)
+        key_data = [
+            [os.fsdecode(argument) for argument in command],
+            [os.fsdecode(process_arguments[name])
+             if process_arguments[name] is not None else None
+             for name in ('executable', 'cwd')],
+            bool(process_arguments['shell']),
+            environment,
+            input_digest]
+        return hashlib.sha256(
+            json.dumps(key_data).encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def lookup(self, key):
+        """Return the cache entry for key as a file opened for
+        reading in binary mode, or None if there is no such entry.
+        Update the hit and miss counters.
+        """
+        entry_path = self.__entry_path(key)
+        try:
+            entry_file = open(entry_path, 'rb')
+        except FileNotFoundError:
+            with self.__lock:
+                self.misses += 1
+            #
+            return None
+        #
+        try:
+            # Mark the entry as recently used
+            os.utime(entry_path)
+        except OSError:
+            pass
+        #
+        with self.__lock:
+            self.hits += 1
+        #
+        return entry_file
+
+    def store(self, key, source):
+        """Store source (bytes or a binary file object)
+        as the cache entry for key and evict old entries
+        """
+        file_descriptor, temp_path = tempfile.mkstemp(
+            dir=self.directory, suffix='.tmp')
+        try:
+            with open(file_descriptor, 'wb') as temp_file:
+                if isinstance(source, bytes):
+                    temp_file.write(source)
+                else:
+                    shutil.copyfileobj(source, temp_file)
+                #
+            #
+            os.replace(temp_path, self.__entry_path(key))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            #
+            raise
+        #
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries
+        until the cache size does not exceed max_size
+        """
+        entries = sorted(self.__entries())
+        total_size = sum(entry[1] for entry in entries)
+        for (unused_mtime, entry_size, entry_path) in entries:
+            if total_size <= self.max_size:
+                break
+            #
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                continue
+            #
+            total_size -= entry_size
+            with self.__lock:
+                self.evictions += 1
+            #
+        #
+
+    def clear(self):
+        """Remove all cache entries"""
+        for entry in self.__entries():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry[2])
+            #
+        #
+
+
+class _AbstractPipeline():
+
+    """Wrapper for a subprocess.Popen() object
+    also storing the result
+
+    Supports keyword arguments for the subprocess.Popen() objects as defined in
+    https://docs.python.org/3.6/library/subprocess.html#popen-constructor
+    with the exception of the deprecated preexec_fn argument.
+    Default values are the same as documented there, except stderr and stdout
+    (both defaulting to subprocess.PIPE).
+
+    Additional keyword arguments:
+        run_immediately (default: False)
+        intermediate_stderr (default: None)
+        input (default: None)
+        timeout (default: None)
+        collect_stats (default: False)
+        pipe_size (default: None)
+        tracer (default: None)
+        use_posix_spawn (default: False)
+        max_output_bytes (default: None)
+        max_error_bytes (default: None)
+        retain_output (default: TAIL)
+        detect_encoding (default: False)
+        compress_output (default: None)
+    """
+
+    defaults = dict(
+        bufsize=-1,
+        executable=None,
+        stdin=None,
+        stdout=PIPE,
+        stderr=PIPE,
+        close_fds=True,
+        shell=False,
+        cwd=None,
+        env=None,
+        universal_newlines=False,
+        startupinfo=None,
+        creationflags=0,
+        restore_signals=True,
+        start_new_session=False,
+        pass_fds=(),
+        encoding=None,
+        errors=None)
+    states = namespaces.Namespace(
+        ready=0,
+        running=1,
+        finished=2)
+    supported_intermediate_stderr = (None, DEVNULL, PIPE, STDOUT)
+    supported_retain_output = (HEAD, TAIL, HEAD_AND_TAIL)
+    supported_compress_output = (None, ZLIB, LZMA)
+    # Subclass specific keyword arguments and their default values,
+    # stored in self.call_arguments
+    additional_call_arguments = {}
+
+    def __init__(self, *commands, **kwargs):
+        """Prepare subprocess(es)"""
+        # Store keyword arguments for the .repeat() method
+        self.__repeatable = namespaces.Namespace(
+            kwargs=kwargs.copy())
+        # Build the actual commands list from the provided
+        # (non-keyword) arguments
+        self.commands = []
+        for single_command in commands:
+            if isinstance(single_command, str):
+                appendable_command = shlex.split(single_command)
+            elif callable(single_command):
+                appendable_command = single_command
+            else:
+                try:
+                    appendable_command = list(single_command)
+                except TypeError as type_error:
+                    raise ValueError(
+                        'Invalid command: {0!r}'.format(
+                            single_command)) from type_error
+                #
+            #
+            if appendable_command:
+                self.commands.append(appendable_command)
+            #
+        #
+        if not self.commands:
+            raise ValueError('Please provide at least one command.')
+        #
+        check = kwargs.pop('check', False)
+        execute_immediately = kwargs.pop('execute_immediately', True)
+        input_ = kwargs.pop('input', None)
+        intermediate_stderr = kwargs.pop('intermediate_stderr', None)
+        if intermediate_stderr not in self.supported_intermediate_stderr:
+            warnings.warn(
+                'Supported values for intermediate_stderr:'
+                ' None, DEVNULL, PIPE or STDOUT. {0!r} has been ignored and'
+                ' substituted by None.'.format(intermediate_stderr))
+            intermediate_stderr = None
+        #
+        retain_output = kwargs.pop('retain_output', TAIL)
+        if retain_output not in self.supported_retain_output:
+            raise ValueError(
+                'Supported values for retain_output: HEAD, TAIL'
+                ' or HEAD_AND_TAIL.')
+        #
+        compress_output = kwargs.pop('compress_output', None)
+        if compress_output not in self.supported_compress_output:
+            raise ValueError(
+                'Supported values for compress_output: None, ZLIB'
+                ' or LZMA.')
+        #
+        if compress_output == LZMA and lzma is None:
+            raise ValueError('The lzma module is not available.')
+        #
+        timeout = kwargs.pop('timeout', None)
+        self.call_arguments = namespaces.Namespace(
+            check=check,
+            collect_stats=kwargs.pop('collect_stats', False),
+            compress_output=compress_output,
+            detect_encoding=kwargs.pop('detect_encoding', False),
+            input=input_,
+            intermediate_stderr=intermediate_stderr,
+            max_error_bytes=kwargs.pop('max_error_bytes', None),
+            max_output_bytes=kwargs.pop('max_output_bytes', None),
+            retain_output=retain_output,
+            pipe_size=kwargs.pop('pipe_size', None),
+            timeout=timeout,
+            tracer=kwargs.pop('tracer', None),
+            use_posix_spawn=kwargs.pop('use_posix_spawn', False))
+        for (name, default) in self.additional_call_arguments.items():
+            self.call_arguments[name] = kwargs.pop(name, default)
+        #
+        pipe_size = self.call_arguments.pipe_size
+        if pipe_size is None or isinstance(pipe_size, int):
+            pipe_sizes = [pipe_size]
+        else:
+            pipe_sizes = self.call_arguments.pipe_size = list(pipe_size)
+            if len(pipe_sizes) != len(self.commands) - 1:
+                raise ValueError(
+                    'Please provide one pipe_size per link between'
+                    ' two commands.')
+            #
+        #
+        for single_size in pipe_sizes:
+            if single_size is not None and not 0 < single_size < 2 ** 31:
+                raise ValueError(
+                    'Invalid pipe_size: {0!r}'.format(single_size))
+            #
+        #
+        for name in ('max_output_bytes', 'max_error_bytes'):
+            limit = self.call_arguments[name]
+            if limit is not None and (
+                    not isinstance(limit, int) or limit < 0):
+                raise ValueError(
+                    'Invalid {0}: {1!r}'.format(name, limit))
+            #
+        #
+        if input_:
+            if kwargs.get('stdin') is not None:
+                raise ValueError(
+                    'stdin and input arguments may not both be used.')
+            #
+            kwargs['stdin'] = PIPE
+        #
+        self.current_state = self.states.ready
+        self.process_arguments = dict(self.defaults)
+        self.process_arguments.update(kwargs)
+        if self.call_arguments.detect_encoding and \
+                _is_text_mode(self.process_arguments):
+            raise ValueError(
+                'detect_encoding cannot be combined with the encoding,'
+                ' errors and universal_newlines arguments.')
+        #
+        if _is_text_mode(self.process_arguments) and \
+                any(callable(command) for command in self.commands):
+            raise ValueError(
+                'Python callables are not supported as commands'
+                ' in text mode.')
+        #
+        self.result = None
+        self.stats = []
+        # Started processes, guarded by self._process_lock
+        # for killing them from another thread
+        self._processes = []
+        self._process_lock = threading.Lock()
+        self._cancel_requested = False
+        self._processes_started = threading.Event()
+        self._trace_id = None
+        # Common monotonic deadline for all commands (None if no timeout)
+        self._deadline = None
+        if execute_immediately:
+            self.execute()
+        #
+
+    def repeat(self):
+        """Create an instance with the same parameters as the current one,
+        re-using the already parsed commands
+        """
+        return self.__class__(*self.commands,
+                              **self.__repeatable.kwargs)
+
+    def _execution_implementation(self):
+        """Override this method in child classes with the implementation
+        of the pipeline call: Start the subprocess(es) and set the result
+        """
+        raise NotImplementedError
+
+    def _open_endpoints(self, exit_stack):
+        """Return the stdin argument for the first command
+        and the stdout argument for the last command,
+        opening the files (and registering them in exit_stack)
+        if paths were provided
+        """
+        endpoints = []
+        for (key, mode) in (('stdin', 'rb'), ('stdout', 'wb')):
+            target = self.process_arguments[key]
+            if isinstance(target, (str, bytes, os.PathLike)):
+                target = exit_stack.enter_context(open(target, mode))
+            #
+            endpoints.append(target)
+        #
+        return endpoints
+
+    def _popen(self, command, **kwargs):
+        """Start a subprocess (see _spawn()) and register it
+        in self._processes, unless the pipeline is being cancelled
+        """
+        spawn_start_time = time.monotonic()
+        with self._process_lock:
+            if self._cancel_requested:
+                raise IllegalStateException(
+                    'The pipeline has been cancelled.')
+            #
+            new_process = self._spawn(command, **kwargs)
+            self._processes.append(new_process)
+            stage_index = len(self._processes) - 1
+        #
+        tracer = self.call_arguments.tracer
+        if tracer:
+            tracer.register_stage(
+                self._trace_id, stage_index, _command_display(command))
+            tracer.add_duration(
+                'spawn',
+                self._trace_id,
+                stage_index,
+                spawn_start_time,
+                time.monotonic(),
+                pid=new_process.pid)
+        #
+        return new_process
+
+    def _trace_instant(self, name, process, **args):
+        """Add an instant event for the process to the tracer
+        if one was provided
+        """
+        tracer = self.call_arguments.tracer
+        if tracer:
+            tracer.add_instant(
+                name, self._trace_id, self._processes.index(process), **args)
+        #
+
+    def _trace_exit(self, process):
+        """Add the exit and the running time of the (finished)
+        process to the tracer if one was provided
+        """
+        tracer = self.call_arguments.tracer
+        if tracer:
+            stage_index = self._processes.index(process)
+            end_time = process.end_time or time.monotonic()
+            tracer.add_instant(
+                'exit',
+                self._trace_id,
+                stage_index,
+                end_time,
+                returncode=process.returncode)
+            tracer.add_duration(
+                'running',
+                self._trace_id,
+                stage_index,
+                process.start_time,
+                end_time,
+                returncode=process.returncode)
+        #
+
+    def _kill_processes(self):
+        """Prevent further processes from being started
+        and kill all running processes of the pipeline
+        """
+        with self._process_lock:
+            self._cancel_requested = True
+            for current_process in self._processes:
+                self._kill_stage(current_process)
+            #
+        #
+
+    def _kill_stage(self, process, signal_number=signal.SIGKILL):
+        """Kill the process (or send it signal_number)
+        if it is still running.
+        If the commands were started with start_new_session=True,
+        signal the whole process group led by the process instead,
+        including any subprocesses the command started itself.
+        """
+        if self.process_arguments['start_new_session'] and process.pid:
+            try:
+                os.killpg(process.pid, signal_number)
+            except (ProcessLookupError, PermissionError):
+                pass
+            #
+        elif process.poll() is None:
+            process.send_signal(signal_number)
+        #
+
+    @property
+    def cancelled(self):
+        """True if the pipeline has been cancelled"""
+        return self._cancel_requested
+
+    def cancel(self, grace_period=DEFAULT_GRACE_PERIOD):
+        """Cancel the pipeline (e.g. from another thread):
+        prevent further processes from being started,
+        terminate all running processes, kill the ones still running
+        after grace_period seconds, and wait for all of them.
+        The thread executing the pipeline sees the processes exit
+        with the negative signal number as returncode.
+        """
+        with self._process_lock:
+            self._cancel_requested = True
+            processes = list(self._processes)
+        #
+        for current_process in processes:
+            self._kill_stage(current_process, signal.SIGTERM)
+        #
+        deadline = time.monotonic() + grace_period
+        for current_process in processes:
+            try:
+                current_process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                self._kill_stage(current_process)
+            #
+        #
+        for current_process in processes:
+            current_process.wait()
+        #
+
+    def _set_deadline(self):
+        """Set the common deadline for all commands
+        from the timeout call argument
+        """
+        timeout = self.call_arguments.timeout
+        if timeout is None:
+            self._deadline = None
+        else:
+            self._deadline = time.monotonic() + timeout
+        #
+
+    def _spawn(self, command, **kwargs):
+        """Start a subprocess, using a subprocess.Popen subclass
+        recording resource usage if collect_stats or tracer was requested.
+        Start a _CallableStage instead if command is a Python callable,
+        or a _SpawnedProcess if use_posix_spawn was requested
+        and the arguments allow it.
+        """
+        if callable(command):
+            return _CallableStage(
+                command, stdin=kwargs['stdin'], stdout=kwargs['stdout'])
+        #
+        if self.call_arguments.use_posix_spawn and \
+                _posix_spawn_possible(kwargs):
+            return _SpawnedProcess(command, **kwargs)
+        #
+        if self.call_arguments.collect_stats or self.call_arguments.tracer:
+            return _AccountingPopen(command, **kwargs)
+        #
+        return subprocess.Popen(command, **kwargs)
+
+    def _set_pipe_size(self, stream, link_index=None):
+        """Set the buffer size of the pipe behind stream if pipe_size
+        was requested (if it is a sequence: the entry for link_index),
+        silently ignoring unsupported platforms and errors
+        """
+        pipe_size = self.call_arguments.pipe_size
+        if isinstance(pipe_size, list):
+            if link_index is None:
+                return
+            #
+            pipe_size = pipe_size[link_index]
+        #
+        if pipe_size is None or stream is None or _F_SETPIPE_SZ is None:
+            return
+        #
+        try:
+            fcntl.fcntl(stream.fileno(), _F_SETPIPE_SZ, pipe_size)
+        except (OSError, ValueError):
+            pass
+        #
+
+    def _record_stats(self, *processes):
+        """Append resource usage records of the processes to self.stats
+        if collect_stats was requested
+        """
+        if self.call_arguments.collect_stats:
+            self.stats.extend(
+                _stats_record(single_process) for single_process in processes)
+        #
+
+    def _new_capture(self, max_bytes=None):
+        """Return an _OutputCapture instance,
+        or a _CompressedCapture instance if compress_output was requested
+        and the output is not limited
+        """
+        if self.call_arguments.compress_output and max_bytes is None:
+            return _CompressedCapture(self.call_arguments.compress_output)
+        #
+        return _OutputCapture(
+            max_bytes=max_bytes,
+            retain=self.call_arguments.retain_output)
+
+    def _stderr_captures(self, processes):
+        """Return a list of _OutputCapture instances for the
+        stderr output of the processes (None if not captured)
+        """
+        return [
+            self._new_capture(self.call_arguments.max_error_bytes)
+            if current_process.stderr else None
+            for current_process in processes]
+
+    def _capture_output(self, processes, input_, max_output_bytes):
+        """Feed input to the first process and capture the output
+        of the processes until all of them have finished.
+        Return the stdout capture of the last process
+        and the list of stderr captures.
+        """
+        stdout_capture = None
+        if processes[-1].stdout:
+            stdout_capture = self._new_capture(max_output_bytes)
+        #
+        stderr_captures = self._stderr_captures(processes)
+        with self._supervision(processes, input_):
+            try:
+                for chunk in self._read_output(
+                        processes, stderr_captures, DEFAULT_CHUNK_SIZE):
+                    stdout_capture.append(chunk)
+                #
+            except subprocess.TimeoutExpired as timeout_expired:
+                if stdout_capture:
+                    timeout_expired.output = self._decode_capture(
+                        stdout_capture)[0]
+                #
+                raise
+            #
+        #
+        return stdout_capture, stderr_captures
+
+    @contextlib.contextmanager
+    def _supervision(self, processes, input_):
+        """Context manager feeding input to the first process,
+        killing all processes if the block is left through an exception
+        (including GeneratorExit), and cleaning up afterwards
+        """
+        self._processes_started.set()
+        input_writer = None
+        input_errors = []
+        if processes[0].stdin:
+            input_writer = threading.Thread(
+                target=self.__feed_input,
+                args=(processes, input_, input_errors),
+                daemon=True)
+            input_writer.start()
+        #
+        try:
+            yield
+        except BaseException:
+            # Kill all processes at once before waiting for any of them,
+            # and close the pipes read in this thread
+            # to unblock pending writes
+            for current_process in processes:
+                self._kill_stage(current_process)
+            #
+            for current_process in processes:
+                for stream in (current_process.stdout,
+                               current_process.stderr):
+                    if stream:
+                        stream.close()
+                    #
+                #
+            #
+            raise
+        finally:
+            for current_process in processes:
+                current_process.wait()
+                self._trace_exit(current_process)
+                for stream in (current_process.stdout,
+                               current_process.stderr):
+                    if stream:
+                        stream.close()
+                    #
+                #
+            #
+            if input_writer:
+                input_writer.join()
+            #
+            self._record_stats(*processes)
+        #
+        if input_errors:
+            raise input_errors[0]
+        #
+
+    def __feed_input(self, processes, input_, input_errors):
+        """Thread target: write input to the first process’ stdin
+        and close it. If writing fails, store the exception
+        in input_errors (to be re-raised in the executing thread)
+        and kill all processes.
+        """
+        try:
+            _write_input(processes[0].stdin, input_)
+        except Exception as error:
+            input_errors.append(error)
+            for current_process in processes:
+                self._kill_stage(current_process)
+            #
+        #
+        self._trace_instant('stdin closed', processes[0])
+
+    def _read_output(self, processes, stderr_captures, chunk_size):
+        """Generator function reading the last process’ stdout
+        and the stderr pipes of all processes through a selector,
+        so no process can be blocked by a full pipe buffer.
+        Yield the stdout chunks and append the stderr chunks
+        to the capture in stderr_captures matching the process.
+        Wait for all processes after all streams have been closed.
+        Raise subprocess.TimeoutExpired if the common deadline
+        of the pipeline expires.
+        If the consumer sends False instead of calling next(),
+        the last process’ stdout is closed (it receives SIGPIPE
+        on further writes), and the stderr pipes are drained
+        until the processes have finished, without yielding anything.
+        """
+        last_process = processes[-1]
+        first_output = True
+        deadline = self._deadline
+        with selectors.DefaultSelector() as selector:
+            if last_process.stdout:
+                selector.register(
+                    last_process.stdout, selectors.EVENT_READ, None)
+            #
+            for current_process, current_capture in zip(
+                    processes, stderr_captures):
+                if current_capture:
+                    selector.register(
+                        current_process.stderr,
+                        selectors.EVENT_READ,
+                        current_capture)
+                #
+            #
+            while selector.get_map():
+                for key, unused_events in selector.select(
+                        self._remaining_time(
+                            deadline, processes, stderr_captures)):
+                    data = os.read(key.fd, chunk_size)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                    elif key.data is None:
+                        if first_output:
+                            self._trace_instant('first output', last_process)
+                            first_output = False
+                        #
+                        if (yield data) is False:
+                            selector.unregister(key.fileobj)
+                            key.fileobj.close()
+                        #
+                    else:
+                        key.data.append(data)
+                    #
+                #
+            #
+        #
+        for current_process in reversed(processes):
+            try:
+                current_process.wait(
+                    self._remaining_time(
+                        deadline, processes, stderr_captures))
+            except subprocess.TimeoutExpired as timeout_expired:
+                raise self._timeout_expired(
+                    processes, stderr_captures) from timeout_expired
+            #
+        #
+
+    def _remaining_time(self, deadline, processes, stderr_captures):
+        """Return the remaining time until deadline (None if no deadline
+        was set) or raise subprocess.TimeoutExpired if it has passed
+        """
+        if deadline is None:
+            return None
+        #
+        remaining_time = deadline - time.monotonic()
+        if remaining_time > 0:
+            return remaining_time
+        #
+        raise self._timeout_expired(processes, stderr_captures)
+
+    def _timeout_expired(self, processes, stderr_captures):
+        """Return a subprocess.TimeoutExpired exception
+        including the last process’ stderr output
+        """
+        stderr = None
+        if stderr_captures[-1]:
+            stderr = self._decode_capture(stderr_captures[-1])[0]
+        #
+        return subprocess.TimeoutExpired(
+            processes[-1].args,
+            self.call_arguments.timeout,
+            stderr=stderr)
+
+    def _decodes_output(self):
+        """Return True if text mode or encoding detection was requested"""
+        return bool(self.call_arguments.detect_encoding
+                    or _is_text_mode(self.process_arguments))
+
+    def _new_decoder(self, errors=None):
+        """Return an incremental decoder for the output
+        (see _OutputDecoder), or None if the output is not decoded
+        """
+        if self._decodes_output():
+            return _OutputDecoder(
+                self.process_arguments,
+                detect_encoding=self.call_arguments.detect_encoding,
+                errors=errors)
+        #
+        return None
+
+    def _decode(self, data):
+        """Decode data if text mode or encoding detection was requested"""
+        return self._decode_with_encoding(data)[0]
+
+    def _decode_with_encoding(self, data):
+        """Decode data if text mode or encoding detection was requested.
+        Return a tuple of the (decoded) data
+        and the encoding name (None if data was not decoded).
+        """
+        decoder = self._new_decoder()
+        if data is None or decoder is None:
+            return (data, None)
+        #
+        return (decoder.decode(data, final=True), decoder.encoding)
+
+    def _decode_capture(self, capture):
+        """Decode the output collected by capture
+        if text mode or encoding detection was requested.
+        Return a tuple of the (decoded) data and the encoding name.
+        Head and tail of truncated output are decoded separately,
+        replacing the partial characters at the cuts
+        unless errors was specified in the process arguments.
+        """
+        if not capture.truncated or not self._decodes_output():
+            return self._decode_with_encoding(capture.getvalue())
+        #
+        head, tail = capture.parts()
+        if self.call_arguments.detect_encoding:
+            # Partial UTF-8 sequences at the cuts
+            # would make encoding detection fall back
+            head = _strip_partial_utf8(head, at_end=True)
+            tail = _strip_partial_utf8(tail, at_start=True)
+        #
+        errors = self.process_arguments.get('errors') or 'replace'
+        head_decoder = self._new_decoder(errors=errors)
+        tail_decoder = self._new_decoder(errors=errors)
+        text = head_decoder.decode(head, final=True) \
+            + tail_decoder.decode(tail, final=True)
+        if tail and not transcode.PRX_NON_ASCII.search(head):
+            return (text, tail_decoder.encoding)
+        #
+        return (text, head_decoder.encoding)
+
+    def _get_result(self, process, stdout_capture=None, stderr_capture=None,
+                    decode_stdout=True):
+        """Return a PipelineResult instance for the finished process"""
+        result = PipelineResult(
+            process.args,
+            process.returncode,
+            exception=getattr(process, 'exception', None))
+        if stdout_capture:
+            self._store_output(
+                result, 'stdout', stdout_capture, decode=decode_stdout)
+        #
+        if stderr_capture:
+            self._store_output(result, 'stderr', stderr_capture)
+        #
+        return result
+
+    def _store_output(self, result, stream_name, capture, decode=True):
+        """Store the captured output of stream_name ('stdout' or 'stderr')
+        in result, decoded if decode is True (and text mode or encoding
+        detection was requested). Compressed output is stored as is
+        and decompressed by the result on each access.
+        """
+        setattr(result, '{0}_bytes'.format(stream_name), capture.total_bytes)
+        setattr(result,
+                '{0}_truncated'.format(stream_name),
+                capture.truncated)
+        if decode:
+            def load_output():
+                """Return the decoded output and its encoding name"""
+                return self._decode_capture(capture)
+            #
+        else:
+            def load_output():
+                """Return the raw output"""
+                return (capture.getvalue(), None)
+            #
+        #
+        if isinstance(capture, _CompressedCapture):
+            setattr(result,
+                    '{0}_compressed_bytes'.format(stream_name),
+                    capture.compressed_bytes)
+            result.set_output_loader(stream_name, load_output)
+            return
+        #
+        output, encoding = load_output()
+        setattr(result, stream_name, output)
+        setattr(result, '{0}_encoding'.format(stream_name), encoding)
+
+    def _check(self, result):
+        """Raise a subprocess.CalledProcessError if check was requested
+        and the result has a non-zero returncode,
+        chained to the exception raised by a Python callable command
+        """
+        if self.call_arguments.check and result.returncode:
+            raise subprocess.CalledProcessError(
+                result.returncode,
+                result.args,
+                output=result.stdout,
+                stderr=result.stderr) from result.exception
+        #
+
+    def _enter_running_state(self, **kwargs):
+        """Check if self.state is ready, set self.state to running
+        or raise an exception.
+        Update self.call_arguments from the keyword arguments
+        check, input, and timeout (each if provided)
+        """
+        if self.current_state != self.states.ready:
+            raise IllegalStateException('Please create a new instance'
+                                        ' using the .repeat() method!')
+        #
+        self.current_state = self.states.running
+        for item in ('check', 'input', 'timeout'):
+            try:
+                self.call_arguments[item] = kwargs[item]
+            except KeyError:
+                continue
+            #
+        #
+        self._set_deadline()
+        if self.call_arguments.input is not None \
+                and self.process_arguments['stdin'] is None:
+            self.process_arguments['stdin'] = PIPE
+        #
+        if self.call_arguments.tracer:
+            self._trace_id = self.call_arguments.tracer.register_pipeline(
+                '{0}: {1}'.format(
+                    self.__class__.__name__,
+                    ' | '.join(_command_display(command)
+                               for command in self.commands)))
+        #
+
+    def execute(self, **kwargs):
+        """Enter the running state and
+        execute the concrete implementation
+        """
+        self._enter_running_state(**kwargs)
+        try:
+            self._execution_implementation()
+        finally:
+            self.current_state = self.states.finished
+        #
+
+    def start(self, **kwargs):
+        """Enter the running state, execute the concrete implementation
+        in a background thread, and return a PipelineFuture instance
+        after the (first) process has been started.
+        Keyword arguments are the same as for the execute() method.
+        """
+        self._enter_running_state(**kwargs)
+        future = PipelineFuture(self)
+        threading.Thread(
+            target=self.__execute_in_background,
+            args=(future,),
+            daemon=True).start()
+        self._processes_started.wait()
+        return future
+
+    def __execute_in_background(self, future):
+        """Execute the concrete implementation
+        and set the outcome of the future
+        """
+        error = None
+        try:
+            self._execution_implementation()
+        except Exception as caught_error:
+            error = caught_error
+        finally:
+            self.current_state = self.states.finished
+            self._processes_started.set()
+        #
+        future.set_outcome(self.result, error)
+
+    @classmethod
+    def run(cls, *commands, **kwargs):
+        """Create an instance, run it immediately and return its result"""
+        kwargs['execute_immediately'] = True
+        pipeline = cls(*commands, **kwargs)
+        return pipeline.result
+
+
+class ProcessChain(_AbstractPipeline):
+
+    """Pseudo pipeline using sequential subprocesses
+    (mimicking subprocess.run())
+
+    Additional keyword arguments:
+        spill_to_disk (default: False): write intermediate output
+            to temporary files instead of keeping it in memory
+        keep_intermediate_results (default: True): keep all results
+            in self.all_results, not only the last one
+        result_cache (default: None): a ResultCache instance
+            used to skip stages that were already run
+            with the same command, environment and input
+    """
+
+    additional_call_arguments = dict(
+        keep_intermediate_results=True,
+        result_cache=None,
+        spill_to_disk=False)
+
+    def __init__(self, *commands, **kwargs):
+        """Initialize the super class"""
+        self.all_results = []
+        super().__init__(*commands, **kwargs)
+
+    def _execution_implementation(self):
+        """Start the subprocess(es) and set the result"""
+        self.all_results.clear()
+        self.stats.clear()
+        last_command_index = len(self.commands) - 1
+        current_input = self.call_arguments.input
+        with contextlib.ExitStack() as exit_stack:
+            current_stdin, last_stdout = self._open_endpoints(exit_stack)
+            for current_index, current_command in enumerate(self.commands):
+                current_arguments = namespaces.Namespace(
+                    self.process_arguments)
+                spill_output = None
+                if current_index < last_command_index:
+                    current_arguments.stdout = PIPE
+                    current_arguments.stderr = \
+                        self.call_arguments.intermediate_stderr
+                    if self.call_arguments.spill_to_disk:
+                        spill_output = exit_stack.enter_context(
+                            tempfile.TemporaryFile())
+                        current_arguments.stdout = spill_output
+                    #
+                else:
+                    current_arguments.stdout = last_stdout
+                #
+                if current_input is not None:
+                    current_stdin = PIPE
+                #
+                if current_index < last_command_index:
+                    max_output_bytes = None
+                else:
+                    max_output_bytes = self.call_arguments.max_output_bytes
+                #
+                # Intermediate output is passed on undecoded
+                # if the encoding is detected
+                decode_stdout = current_index == last_command_index \
+                    or not self.call_arguments.detect_encoding
+                cache_key = self._cache_key(
+                    current_command,
+                    current_input,
+                    current_stdin,
+                    current_arguments.stderr,
+                    current_arguments.stdout == PIPE or spill_output)
+                if cache_key:
+                    current_result = self._cached_stage_result(
+                        cache_key,
+                        current_command,
+                        spill_output,
+                        max_output_bytes,
+                        decode_stdout=decode_stdout)
+                else:
+                    current_result = None
+                #
+                if current_result is None:
+                    current_process = self._popen(
+                        current_command,
+                        bufsize=current_arguments.bufsize,
+                        executable=current_arguments.executable,
+                        stdin=current_stdin,
+                        stdout=current_arguments.stdout,
+                        stderr=current_arguments.stderr,
+                        close_fds=current_arguments.close_fds,
+                        shell=current_arguments.shell,
+                        cwd=current_arguments.cwd,
+                        env=current_arguments.env,
+                        universal_newlines=(
+                            current_arguments.universal_newlines),
+                        startupinfo=current_arguments.startupinfo,
+                        creationflags=current_arguments.creationflags,
+                        restore_signals=current_arguments.restore_signals,
+                        start_new_session=current_arguments.start_new_session,
+                        pass_fds=current_arguments.pass_fds,
+                        encoding=current_arguments.encoding,
+                        errors=current_arguments.errors)
+                    for stream in (current_process.stdin,
+                                   current_process.stdout):
+                        self._set_pipe_size(stream)
+                    #
+                    current_result = self._complete_stage(
+                        current_process,
+                        current_input,
+                        max_output_bytes,
+                        cache_key=cache_key,
+                        spill_output=spill_output,
+                        decode_stdout=decode_stdout)
+                #
+                if spill_output:
+                    # Pass the spill file to the next command
+                    spill_output.seek(0)
+                #
+                if current_index and hasattr(current_stdin, 'close'):
+                    # Close the spill file consumed by this command,
+                    # but never the stdin file object of the first one
+                    current_stdin.close()
+                #
+                current_stdin = spill_output
+                current_input = current_result.stdout
+                if self.call_arguments.keep_intermediate_results \
+                        or current_index == last_command_index:
+                    self.all_results.append(current_result)
+                #
+            #
+        #
+        self.result = self.all_results[-1]
+
+    def _cache_key(self, command, input_, stdin, stderr, output_cacheable):
+        """Return the result cache key for the stage,
+        or None if no result cache was requested
+        or the stage result cannot be cached
+        (i.e. output that is neither captured nor spilled to disk,
+        output mixed with standard error, or input that cannot be hashed)
+        """
+        result_cache = self.call_arguments.result_cache
+        if result_cache is None or callable(command) \
+                or not output_cacheable or stderr == STDOUT:
+            return None
+        #
+        input_digest = _input_digest(input_, stdin)
+        if input_digest is None:
+            return None
+        #
+        return result_cache.key(command, self.process_arguments, input_digest)
+
+    def _cached_stage_result(self, cache_key, command,
+                             spill_output, max_output_bytes,
+                             decode_stdout=True):
+        """Return a PipelineResult instance from the result cache,
+        or None on a cache miss.
+        Write the cached output to the spill file if there is one.
+        """
+        cached_file = self.call_arguments.result_cache.lookup(cache_key)
+        if cached_file is None:
+            return None
+        #
+        result = PipelineResult(command, 0)
+        with cached_file:
+            if spill_output:
+                shutil.copyfileobj(cached_file, spill_output)
+            else:
+                stdout_capture = self._new_capture(max_output_bytes)
+                stdout_capture.append(cached_file.read())
+                self._store_output(
+                    result, 'stdout', stdout_capture, decode=decode_stdout)
+            #
+        #
+        return result
+
+    def _complete_stage(self, process, input_, max_output_bytes,
+                        cache_key=None, spill_output=None,
+                        decode_stdout=True):
+        """Feed input to the process, read its output
+        and return a PipelineResult instance
+        (mimicking subprocess.run()).
+        Store the complete output of a successful process
+        in the result cache if a cache key was provided.
+        """
+        stdout_capture, stderr_captures = self._capture_output(
+            [process], input_, max_output_bytes)
+        if cache_key and process.returncode == 0:
+            if spill_output:
+                spill_output.seek(0)
+                self.call_arguments.result_cache.store(
+                    cache_key, spill_output)
+            elif not stdout_capture.truncated:
+                self.call_arguments.result_cache.store(
+                    cache_key, stdout_capture.getvalue())
+            #
+        #
+        result = self._get_result(
+            process,
+            stdout_capture,
+            stderr_captures[0],
+            decode_stdout=decode_stdout)
+        self._check(result)
+        return result
+
+
+class ProcessPipeline(_AbstractPipeline):
+
+    """Pipeline using parallel subprocesses as described in
+    https://docs.python.org/3/library/subprocess.html#replacing-shell-pipeline
+
+    The output of all processes is read through a selector.
+    self.all_results contains a subprocess.CompletedProcess instance
+    for each command, with the stderr output if it was captured.
+    """
+
+    def __init__(self, *commands, **kwargs):
+        """Initialize the super class"""
+        self.all_results = []
+        super().__init__(*commands, **kwargs)
+
+    def _start_processes(self):
+        """Start the subprocesses, connect them
+        and return the list of subprocess.Popen objects
+        """
+        processes = []
+        last_command_index = len(self.commands) - 1
+        with contextlib.ExitStack() as exit_stack:
+            # Files opened here are closed after starting the subprocesses
+            try:
+                first_stdin, last_stdout = self._open_endpoints(exit_stack)
+            except OSError:
+                self.current_state = self.states.finished
+                raise
+            #
+            for current_index, current_command in enumerate(self.commands):
+                current_arguments = namespaces.Namespace(
+                    self.process_arguments)
+                if current_index > 0:
+                    current_arguments.stdin = \
+                        processes[current_index - 1].stdout
+                else:
+                    current_arguments.stdin = first_stdin
+                #
+                if current_index < last_command_index:
+                    current_arguments.stdout = PIPE
+                    current_arguments.stderr = \
+                        self.call_arguments.intermediate_stderr
+                else:
+                    current_arguments.stdout = last_stdout
+                #
+                try:
+                    current_process = self._popen(
+                        current_command,
+                        bufsize=current_arguments.bufsize,
+                        executable=current_arguments.executable,
+                        stdin=current_arguments.stdin,
+                        stdout=current_arguments.stdout,
+                        stderr=current_arguments.stderr,
+                        close_fds=current_arguments.close_fds,
+                        shell=current_arguments.shell,
+                        cwd=current_arguments.cwd,
+                        env=current_arguments.env,
+                        universal_newlines=(
+                            current_arguments.universal_newlines),
+                        startupinfo=current_arguments.startupinfo,
+                        creationflags=current_arguments.creationflags,
+                        restore_signals=current_arguments.restore_signals,
+                        start_new_session=(
+                            current_arguments.start_new_session),
+                        pass_fds=current_arguments.pass_fds,
+                        encoding=current_arguments.encoding,
+                        errors=current_arguments.errors)
+                except (OSError, ValueError):
+                    self.current_state = self.states.finished
+                    # Do not leave the already started processes behind
+                    for started_process in processes:
+                        self._kill_stage(started_process)
+                        started_process.wait()
+                        for stream in (started_process.stdin,
+                                       started_process.stdout,
+                                       started_process.stderr):
+                            if stream:
+                                stream.close()
+                            #
+                        #
+                    #
+                    raise
+                #
+                processes.append(current_process)
+                if current_index == 0:
+                    self._set_pipe_size(current_process.stdin)
+                #
+                if current_index < last_command_index:
+                    self._set_pipe_size(current_process.stdout, current_index)
+                else:
+                    self._set_pipe_size(current_process.stdout)
+                #
+            #
+        #
+        # Close stdout to allow processes to receive SIGPIPE.
+        for current_index in range(last_command_index):
+            processes[current_index].stdout.close()
+        #
+        if self.call_arguments.collect_stats or self.call_arguments.tracer:
+            # Reap intermediate processes as soon as they exit
+            # to record their correct wall times
+            for current_process in processes[:-1]:
+                threading.Thread(
+                    target=current_process.wait,
+                    daemon=True).start()
+            #
+        #
+        return processes
+
+    def _execution_implementation(self):
+        """Start the subprocess(es) and set the result"""
+        processes = self._start_processes()
+        stdout_capture, stderr_captures = self._capture_output(
+            processes,
+            self.call_arguments.input,
+            self.call_arguments.max_output_bytes)
+        self._set_results(processes, stdout_capture, stderr_captures)
+
+    def iter_stdout(self, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+        """Start the pipeline and return an iterator over the
+        last command’s standard output, yielding chunks of at most
+        chunk_size bytes (or characters in text mode)
+        while the commands are still running.
+        Keyword arguments are the same as for the execute() method.
+        After the iterator has been exhausted, self.result is set
+        (with stdout set to None), and check is applied.
+        """
+        if self.process_arguments['stdout'] != PIPE:
+            raise ValueError('Streaming requires stdout=PIPE.')
+        #
+        self._enter_running_state(**kwargs)
+        return self._stream_stdout(chunk_size)
+
+    def iter_lines(self, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+        """Start the pipeline and return an iterator over the
+        lines of the last command’s standard output
+        (including the line endings), see iter_stdout()
+        """
+        chunks = self.iter_stdout(chunk_size=chunk_size, **kwargs)
+        if self._decodes_output():
+            return _split_chunks(chunks, '\n')
+        #
+        return _split_chunks(chunks, b'\n')
+
+    def iter_records(self, record_separator='\n', decode_json=False,
+                     as_namespace=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                     **kwargs):
+        """Start the pipeline and return an iterator over the
+        records of the last command’s standard output
+        (without the record separator), see iter_stdout().
+        Use record_separator='\\0' for NUL-delimited output.
+        If decode_json is True, each non-blank record is decoded
+        from JSON (e.g. JSON Lines output), JSON objects
+        into namespaces.Namespace instances if as_namespace is True.
+        """
+        if not record_separator:
+            raise ValueError('record_separator must not be empty.')
+        #
+        if self._decodes_output():
+            if isinstance(record_separator, bytes):
+                record_separator = record_separator.decode()
+            #
+        elif isinstance(record_separator, str):
+            record_separator = record_separator.encode()
+        #
+        records = _split_chunks(
+            self.iter_stdout(chunk_size=chunk_size, **kwargs),
+            record_separator,
+            keep_separator=False)
+        if not decode_json:
+            return records
+        #
+        if as_namespace:
+            object_hook = namespaces.Namespace
+        else:
+            object_hook = None
+        #
+        return (json.loads(record, object_hook=object_hook)
+                for record in records if record.strip())
+
+    def _stream_stdout(self, chunk_size):
+        """Generator function starting the processes and yielding
+        the last process’ stdout chunks (decoded in text mode
+        or if encoding detection was requested)
+        """
+        processes = self._start_processes()
+        stderr_captures = self._stderr_captures(processes)
+        decoder = self._new_decoder()
+        try:
+            with self._supervision(processes, self.call_arguments.input):
+                for chunk in self._read_output(
+                        processes, stderr_captures, chunk_size):
+                    if decoder:
+                        chunk = decoder.decode(chunk)
+                        if not chunk:
+                            continue
+                        #
+                    #
+                    yield chunk
+                #
+                if decoder:
+                    remainder = decoder.decode(b'', final=True)
+                    if remainder:
+                        yield remainder
+                    #
+                #
+            #
+        finally:
+            self.current_state = self.states.finished
+        #
+        self._set_results(
+            processes,
+            None,
+            stderr_captures,
+            stdout_encoding=decoder.encoding if decoder else None)
+
+    def _set_results(self, processes, stdout_capture, stderr_captures,
+                     stdout_encoding=None):
+        """Set self.all_results and self.result
+        (with stdout_encoding if the output was streamed),
+        and apply check
+        """
+        self.all_results.clear()
+        for current_process, current_capture in zip(
+                processes, stderr_captures):
+            self.all_results.append(
+                self._get_result(
+                    current_process, stderr_capture=current_capture))
+        #
+        self.result = self._get_result(
+            processes[-1], stdout_capture, stderr_captures[-1])
+        if stdout_encoding:
+            self.result.stdout_encoding = stdout_encoding
+        #
+        self.all_results[-1] = self.result
+        self._check(self.result)
+
+
+class CoprocessPipeline(ProcessPipeline):
+
+    """Persistent pipeline keeping its processes running
+    and streaming many input records through them,
+    returning the matching output record for each input record.
+
+    The commands must produce exactly one output record
+    per input record without buffering their output
+    (e.g. "sed -u", "grep --line-buffered" or "stdbuf -oL ..."),
+    otherwise waiting for the output blocks until the timeout expires.
+
+    Additional keyword arguments:
+        record_separator (default: newline): separator used for
+            framing input and output records, e.g. '\\0'
+    """
+
+    additional_call_arguments = dict(record_separator='\n')
+
+    def __init__(self, *commands, **kwargs):
+        """Check the arguments and initialize the super class"""
+        if kwargs.get('input') is not None:
+            raise ValueError(
+                'input is not supported in coprocess pipelines.'
+                ' Please use the .process_records() method.')
+        #
+        for stream in ('stdin', 'stdout'):
+            if kwargs.get(stream, PIPE) not in (None, PIPE):
+                raise ValueError(
+                    'Coprocess pipelines require {0}=PIPE.'.format(stream))
+            #
+        #
+        kwargs['stdin'] = kwargs['stdout'] = PIPE
+        self.__processes = []
+        self.__stderr_captures = []
+        # Raw output not yet split into records,
+        # raw input not yet written, and the number of
+        # output records belonging to abandoned input records
+        self.__output_buffer = b''
+        self.__write_buffer = bytearray()
+        self.__abandoned_records = 0
+        super().__init__(*commands, **kwargs)
+        record_separator = self.call_arguments.record_separator
+        if not record_separator:
+            raise ValueError('record_separator must not be empty.')
+        #
+        self.__separator = self.__encode(record_separator)
+
+    def __encode(self, data):
+        """Return data as bytes, encoded in text mode"""
+        if isinstance(data, str):
+            return data.encode(
+                self.process_arguments.get('encoding')
+                or locale.getpreferredencoding(False),
+                self.process_arguments.get('errors') or 'strict')
+        #
+        return data
+
+    def execute(self, **kwargs):
+        """Start the processes and keep them running
+        until the close() method is called
+        """
+        self._enter_running_state(**kwargs)
+        self.__processes = self._start_processes()
+        self.__stderr_captures = self._stderr_captures(self.__processes)
+        os.set_blocking(self.__processes[0].stdin.fileno(), False)
+
+    def start(self, **kwargs):
+        """Not supported, execute() does not block here"""
+        raise TypeError(
+            'Coprocess pipelines are started using the .execute() method.')
+
+    def iter_stdout(self, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+        """Not supported, the output is read record by record
+        (also affects iter_lines() and iter_records())
+        """
+        raise TypeError(
+            'Please use the .process_record() or .process_records() method'
+            ' to read the output of coprocess pipelines.')
+
+    def __enter__(self):
+        """Context manager entry: start the processes if required"""
+        if self.current_state == self.states.ready:
+            self.execute()
+        #
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Context manager exit: kill the processes on an exception,
+        and close the pipeline
+        """
+        if exc_type and self.current_state == self.states.running:
+            self.__kill()
+        #
+        self.close()
+
+    def __kill(self):
+        """Kill all processes"""
+        for current_process in self.__processes:
+            self._kill_stage(current_process)
+        #
+
+    def close(self):
+        """Close the first process’ standard input, wait for all
+        processes and set the results (with stdout set to the
+        output following the last complete output record).
+        Do nothing if the pipeline is not running.
+        """
+        if self.current_state != self.states.running:
+            return
+        #
+        processes = self.__processes
+        stdout_capture = self._new_capture(
+            self.call_arguments.max_output_bytes)
+        stdout_capture.append(self.__output_buffer)
+        os.set_blocking(processes[0].stdin.fileno(), True)
+        if _is_text_mode(self.process_arguments):
+            empty_input = ''
+        else:
+            empty_input = b''
+        #
+        # The timeout applies to the final wait here as well
+        self._set_deadline()
+        try:
+            with self._supervision(processes, empty_input):
+                for chunk in self._read_output(
+                        processes,
+                        self.__stderr_captures,
+                        DEFAULT_CHUNK_SIZE):
+                    stdout_capture.append(chunk)
+                #
+            #
+        finally:
+            self.current_state = self.states.finished
+        #
+        self._set_results(processes, stdout_capture, self.__stderr_captures)
+
+    def process_record(self, record):
+        """Send a single record through the pipeline
+        and return the matching output record
+        """
+        for output_record in self.process_records((record,)):
+            return output_record
+        #
+
+    def process_records(self, records):
+        """Return an iterator sending the records through the pipeline
+        (without waiting for output before sending the next record)
+        and yielding the matching output records
+        (without record separators)
+        """
+        if self.current_state != self.states.running:
+            raise IllegalStateException('The pipeline is not running.')
+        #
+        return self.__exchange(iter(records))
+
+    def __exchange(self, records):
+        """Generator function writing the input records
+        and reading the output records through a selector
+        """
+        first_process = self.__processes[0]
+        last_process = self.__processes[-1]
+        timeout = self.call_arguments.timeout
+        pending_records = self.__abandoned_records
+        records_exhausted = False
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(
+                    last_process.stdout, selectors.EVENT_READ, None)
+                for current_process, current_capture in zip(
+                        self.__processes, self.__stderr_captures):
+                    if current_capture:
+                        selector.register(
+                            current_process.stderr,
+                            selectors.EVENT_READ,
+                            current_capture)
+                    #
+                #
+                writing = False
+                while True:
+                    while pending_records:
+                        output_record = self.__next_output_record()
+                        if output_record is None:
+                            break
+                        #
+                        pending_records -= 1
+                        if self.__abandoned_records:
+                            self.__abandoned_records -= 1
+                            continue
+                        #
+                        yield output_record
+                    #
+                    if not self.__write_buffer and not records_exhausted:
+                        try:
+                            record = next(records)
+                        except StopIteration:
+                            records_exhausted = True
+                        else:
+                            self.__write_buffer.extend(
+                                self.__encode(record) + self.__separator)
+                            pending_records += 1
+                        #
+                    #
+                    if records_exhausted and not pending_records:
+                        return
+                    #
+                    if self.__write_buffer and not writing:
+                        selector.register(
+                            first_process.stdin, selectors.EVENT_WRITE, None)
+                        writing = True
+                    elif writing and not self.__write_buffer:
+                        selector.unregister(first_process.stdin)
+                        writing = False
+                    #
+                    ready = selector.select(timeout)
+                    if not ready:
+                        self.__kill()
+                        self.close()
+                        raise subprocess.TimeoutExpired(
+                            last_process.args, timeout)
+                    #
+                    for key, events in ready:
+                        if events & selectors.EVENT_WRITE:
+                            self.__write_input(key.fd)
+                        elif key.data is None:
+                            self.__read_output(key.fd)
+                        else:
+                            data = os.read(key.fd, DEFAULT_CHUNK_SIZE)
+                            if data:
+                                key.data.append(data)
+                            else:
+                                selector.unregister(key.fileobj)
+                            #
+                        #
+                    #
+                #
+            #
+        finally:
+            # Output for records sent by an abandoned iterator
+            # has to be discarded by the next one
+            self.__abandoned_records = pending_records
+        #
+
+    def __write_input(self, file_descriptor):
+        """Write as much of the write buffer as possible"""
+        try:
+            written_bytes = os.write(file_descriptor, self.__write_buffer)
+        except BlockingIOError:
+            return
+        except BrokenPipeError:
+            self.__terminated()
+        #
+        del self.__write_buffer[:written_bytes]
+
+    def __read_output(self, file_descriptor):
+        """Read from the last process’ standard output"""
+        data = os.read(file_descriptor, DEFAULT_CHUNK_SIZE)
+        if not data:
+            self.__terminated()
+        #
+        self.__output_buffer += data
+
+    def __terminated(self):
+        """Close the pipeline after a process terminated prematurely
+        and raise an IllegalStateException
+        (or a subprocess.CalledProcessError if check was requested)
+        """
+        self.__kill()
+        self.close()
+        raise IllegalStateException(
+            'The pipeline terminated before all records were processed'
+            ' (return codes: {0!r}).'.format(
+                [result.returncode for result in self.all_results]))
+
+    def __next_output_record(self):
+        """Split off and return the next complete output record
+        (decoded in text mode), or None if there is none yet
+        """
+        record, separator, remainder = \
+            self.__output_buffer.partition(self.__separator)
+        if not separator:
+            return None
+        #
+        self.__output_buffer = remainder
+        return self._decode(record)
+
+
+class FanOutPipeline(ProcessPipeline):
+
+    """Pipeline copying the last command’s standard output
+    to the standard input of several branch pipelines
+    running in parallel (like the tee command).
+
+    Additional keyword arguments:
+        branches: a sequence of branches, each either a single
+            command string, a sequence of commands
+            (run in a ProcessPipeline), or a ProcessPipeline
+            or ProcessChain instance without stdin or input argument,
+            used as a template (see the repeat() method).
+    The output is read once and written to each branch from the same
+    buffer. Branches that exit prematurely are skipped.
+    self.branches contains the branch pipelines (with their own results),
+    self.result contains the last command’s result without stdout.
+    """
+
+    additional_call_arguments = dict(branches=())
+
+    def __init__(self, *commands, **kwargs):
+        """Build the branch pipelines and initialize the super class"""
+        if kwargs.get('stdout', PIPE) != PIPE:
+            raise ValueError('stdout is not supported in fan-out pipelines.')
+        #
+        self.branches = []
+        for branch in kwargs.get('branches') or ():
+            if isinstance(branch, (ProcessPipeline, ProcessChain)):
+                if isinstance(branch, CoprocessPipeline) \
+                        or branch.process_arguments['stdin'] is not None \
+                        or branch.call_arguments.input is not None:
+                    raise ValueError(
+                        'Invalid branch pipeline: {0!r}'.format(branch))
+                #
+                # Use a fresh copy, leaving the provided instance unchanged
+                branch = branch.repeat()
+            elif isinstance(branch, str):
+                branch = ProcessPipeline(branch, execute_immediately=False)
+            else:
+                branch = ProcessPipeline(*branch, execute_immediately=False)
+            #
+            self.branches.append(branch)
+        #
+        if not self.branches:
+            raise ValueError('Please provide at least one branch.')
+        #
+        super().__init__(*commands, **kwargs)
+
+    def iter_stdout(self, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+        """Not supported, the output is sent to the branches"""
+        raise TypeError(
+            'The output of fan-out pipelines is sent to the branches.')
+
+    def _execution_implementation(self):
+        """Start the subprocess(es) and the branches,
+        copy the output to the branches and set the results
+        """
+        processes = self._start_processes()
+        stderr_captures = self._stderr_captures(processes)
+        branch_fds = []
+        futures = []
+        try:
+            for branch in self.branches:
+                read_fd, write_fd = os.pipe()
+                branch_fds.append(write_fd)
+                branch.process_arguments['stdin'] = read_fd
+                try:
+                    futures.append(branch.start())
+                finally:
+                    os.close(read_fd)
+                #
+            #
+            with self._supervision(processes, self.call_arguments.input):
+                output_chunks = self._read_output(
+                    processes, stderr_captures, DEFAULT_CHUNK_SIZE)
+                for chunk in output_chunks:
+                    if not self.__distribute(chunk, branch_fds):
+                        # All branches have exited:
+                        # let the last command receive SIGPIPE,
+                        # but keep draining the stderr pipes
+                        try:
+                            output_chunks.send(False)
+                        except StopIteration:
+                            pass
+                        #
+                        break
+                    #
+                #
+            #
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            #
+            raise
+        finally:
+            for write_fd in branch_fds:
+                if write_fd is not None:
+                    os.close(write_fd)
+                #
+            #
+            for future in futures:
+                future.wait()
+            #
+        #
+        self._set_results(processes, None, stderr_captures)
+        for future in futures:
+            # Re-raise the first exception from a branch
+            future.result()
+        #
+
+    @staticmethod
+    def __distribute(chunk, branch_fds):
+        """Write the chunk to all branch pipes,
+        closing (and replacing by None) the broken ones.
+        Return False if no branch is left.
+        """
+        for branch_index, write_fd in enumerate(branch_fds):
+            if write_fd is None:
+                continue
+            #
+            pending_data = memoryview(chunk)
+            try:
+                while pending_data:
+                    written_bytes = os.write(write_fd, pending_data)
+                    pending_data = pending_data[written_bytes:]
+                #
+            except BrokenPipeError:
+                os.close(write_fd)
+                branch_fds[branch_index] = None
+            #
+        #
+        return any(write_fd is not None for write_fd in branch_fds)
+
+
+class ParallelStage():
+
+    """Callable for use as a pipeline command, splitting its input
+    into blocks of about block_size bytes on record boundaries,
+    running up to copies instances of command concurrently
+    (one ProcessPipeline per block, like "parallel --pipe --keep-order")
+    and yielding their outputs in the original order.
+
+    Additional keyword arguments are passed to the block pipelines
+    (check is always set to True there).
+    """
+
+    def __init__(self, command, copies=None, record_separator=b'\n',
+                 block_size=DEFAULT_BLOCK_SIZE, **kwargs):
+        """Store the arguments"""
+        if copies is None:
+            copies = os.cpu_count() or 1
+        #
+        if copies < 1:
+            raise ValueError('copies must be at least 1.')
+        #
+        if not isinstance(record_separator, bytes) or not record_separator:
+            raise ValueError('record_separator must be non-empty bytes.')
+        #
+        self.command = command
+        self.copies = copies
+        self.record_separator = record_separator
+        self.block_size = block_size
+        self.kwargs = dict(kwargs, check=True, execute_immediately=False)
+
+    def __repr__(self):
+        """Representation as used in results"""
+        return '{0}({1!r}, copies={2!r})'.format(
+            self.__class__.__name__, self.command, self.copies)
+
+    def __iter_blocks(self, input_file):
+        """Yield blocks ending at a record boundary
+        (except the last one if the input does not end with a separator)
+        """
+        remainder = b''
+        while True:
+            data = input_file.read(self.block_size)
+            if not data:
+                break
+            #
+            data = remainder + data
+            boundary = data.rfind(self.record_separator)
+            if boundary < 0:
+                remainder = data
+                continue
+            #
+            boundary += len(self.record_separator)
+            yield data[:boundary]
+            remainder = data[boundary:]
+        #
+        if remainder:
+            yield remainder
+        #
+
+    def __call__(self, input_file):
+        """Generator function processing the input blocks
+        in parallel and yielding the outputs in order
+        """
+        pending_futures = collections.deque()
+        try:
+            for block in self.__iter_blocks(input_file):
+                if len(pending_futures) >= self.copies:
+                    yield pending_futures.popleft().result().stdout
+                #
+                pending_futures.append(
+                    ProcessPipeline(
+                        self.command, input=block, **self.kwargs).start())
+            #
+            while pending_futures:
+                yield pending_futures.popleft().result().stdout
+            #
+        finally:
+            # Kill the remaining block pipelines after an error
+            for future in pending_futures:
+                future.cancel()
+            #
+        #
+
+
+class _AbstractAsyncPipeline(_AbstractPipeline):
+
+    """Base class for pipelines using asyncio subprocesses.
+    Instances are never executed immediately,
+    the execute() method and the run() classmethod are coroutines.
+
+    Text mode is emulated by decoding the collected output;
+    shell=True is not supported.
+    """
+
+    # Process arguments handled by the pipeline itself
+    # or not supported by asyncio subprocesses
+    not_passed_through = (
+        'bufsize', 'stdin', 'stdout', 'stderr', 'shell',
+        'universal_newlines', 'encoding', 'errors')
+
+    def __init__(self, *commands, **kwargs):
+        """Initialize the super class without executing"""
+        if kwargs.pop('execute_immediately', False):
+            raise ValueError(
+                'Asynchronous pipelines cannot be executed immediately.'
+                ' Please await the .execute() method.')
+        #
+        for unsupported in ('shell', 'collect_stats', 'compress_output',
+                            'pipe_size', 'tracer', 'use_posix_spawn',
+                            'max_output_bytes', 'max_error_bytes'):
+            if kwargs.get(unsupported) not in (None, False):
+                raise ValueError(
+                    '{0} is not supported in asynchronous'
+                    ' pipelines.'.format(unsupported))
+            #
+        #
+        if any(callable(command) for command in commands):
+            raise ValueError(
+                'Python callables are not supported as commands'
+                ' in asynchronous pipelines.')
+        #
+        kwargs['execute_immediately'] = False
+        super().__init__(*commands, **kwargs)
+
+    def start(self, **kwargs):
+        """Not supported in asynchronous pipelines"""
+        raise TypeError(
+            'Please use asyncio.ensure_future(pipeline.execute())'
+            ' to run an asynchronous pipeline in the background.')
+
+    def cancel(self, grace_period=DEFAULT_GRACE_PERIOD):
+        """Not supported in asynchronous pipelines"""
+        raise TypeError(
+            'Please cancel the task awaiting the .execute() method'
+            ' to cancel an asynchronous pipeline.')
+
+    async def execute(self, **kwargs):
+        """Enter the running state and
+        execute the concrete implementation
+        """
+        self._enter_running_state(**kwargs)
+        try:
+            await self._execution_implementation()
+        finally:
+            self.current_state = self.states.finished
+        #
+
+    @classmethod
+    async def run(cls, *commands, **kwargs):
+        """Create an instance, execute it and return its result"""
+        pipeline = cls(*commands, **kwargs)
+        await pipeline.execute()
+        return pipeline.result
+
+    async def _create_process(self, command, stdin, stdout, stderr):
+        """Start a single asyncio subprocess"""
+        popen_arguments = {
+            key: value for (key, value) in self.process_arguments.items()
+            if key not in self.not_passed_through}
+        return await asyncio.create_subprocess_exec(
+            *command,
+            stdin=stdin,
+            stdout=stdout,
+            stderr=stderr,
+            **popen_arguments)
+
+    def _remaining_seconds(self):
+        """Return the time until the common deadline
+        (None if no timeout was set)
+        """
+        if self._deadline is None:
+            return None
+        #
+        return max(self._deadline - time.monotonic(), 0)
+
+    def _kill(self, process):
+        """Kill the process (or its process group,
+        see _AbstractPipeline._kill_stage())
+        """
+        _kill_async_process(
+            process,
+            process_group=self.process_arguments['start_new_session'])
+
+    async def _kill_all(self, processes):
+        """Kill all processes at once and wait for them"""
+        for current_process in processes:
+            self._kill(current_process)
+        #
+        for current_process in processes:
+            await current_process.wait()
+        #
+
+    def _collected_result(self, command, returncode, stdout, stderr):
+        """Return a PipelineResult instance from the collected output"""
+        result = PipelineResult(command, returncode)
+        result.stdout, result.stdout_encoding = \
+            self._decode_with_encoding(stdout)
+        result.stderr, result.stderr_encoding = \
+            self._decode_with_encoding(stderr)
+        if stdout is not None:
+            result.stdout_bytes = len(stdout)
+        #
+        if stderr is not None:
+            result.stderr_bytes = len(stderr)
+        #
+        return result
+
+
+class AsyncProcessChain(_AbstractAsyncPipeline):
+
+    """Pseudo pipeline using sequential asyncio subprocesses"""
+
+    def __init__(self, *commands, **kwargs):
+        """Initialize the super class"""
+        self.all_results = []
+        super().__init__(*commands, **kwargs)
+
+    async def _execution_implementation(self):
+        """Start the subprocess(es) and set the result"""
+        self.all_results.clear()
+        last_command_index = len(self.commands) - 1
+        current_input = self.call_arguments.input
+        with contextlib.ExitStack() as exit_stack:
+            first_stdin, last_stdout = self._open_endpoints(exit_stack)
+            for current_index, current_command in enumerate(self.commands):
+                if current_index < last_command_index:
+                    stdout = PIPE
+                    stderr = self.call_arguments.intermediate_stderr
+                else:
+                    stdout = last_stdout
+                    stderr = self.process_arguments['stderr']
+                #
+                if current_input is None:
+                    stdin = first_stdin
+                else:
+                    stdin = PIPE
+                    if current_index == 0 and \
+                            _is_text_mode(self.process_arguments):
+                        current_input = current_input.encode(
+                            self.process_arguments['encoding']
+                            or locale.getpreferredencoding(False))
+                    #
+                #
+                current_process = await self._create_process(
+                    current_command, stdin, stdout, stderr)
+                try:
+                    stdout_data, stderr_data = await asyncio.wait_for(
+                        current_process.communicate(current_input),
+                        self._remaining_seconds())
+                except asyncio.TimeoutError as timeout_error:
+                    await self._kill_all([current_process])
+                    raise subprocess.TimeoutExpired(
+                        current_command,
+                        self.call_arguments.timeout) from timeout_error
+                except BaseException:
+                    # e.g. cancellation of the awaiting task
+                    await self._kill_all([current_process])
+                    raise
+                #
+                current_result = self._collected_result(
+                    current_command,
+                    current_process.returncode,
+                    stdout_data,
+                    stderr_data)
+                self._check(current_result)
+                self.all_results.append(current_result)
+                current_input = stdout_data
+            #
+        #
+        self.result = self.all_results[last_command_index]
+
+
+class AsyncProcessPipeline(_AbstractAsyncPipeline):
+
+    """Pipeline using parallel asyncio subprocesses
+    connected through OS pipes.
+    Contrary to ProcessPipeline, input is always sent
+    to the first command.
+    """
+
+    def __init__(self, *commands, **kwargs):
+        """Initialize the super class"""
+        self.all_results = []
+        super().__init__(*commands, **kwargs)
+
+    async def _execution_implementation(self):
+        """Start the subprocess(es) and set the result"""
+        input_ = self.call_arguments.input
+        if input_ is not None and _is_text_mode(self.process_arguments):
+            input_ = input_.encode(
+                self.process_arguments['encoding']
+                or locale.getpreferredencoding(False))
+        #
+        exit_stack = contextlib.ExitStack()
+        stdin, last_stdout = self._open_endpoints(exit_stack)
+        if input_ is not None:
+            stdin = PIPE
+        #
+        processes = []
+        parent_fds = []
+        last_command_index = len(self.commands) - 1
+        try:
+            for current_index, current_command in enumerate(self.commands):
+                if current_index < last_command_index:
+                    read_fd, stdout = os.pipe()
+                    parent_fds.extend((read_fd, stdout))
+                    stderr = self.call_arguments.intermediate_stderr
+                else:
+                    read_fd = None
+                    stdout = last_stdout
+                    stderr = self.process_arguments['stderr']
+                #
+                processes.append(
+                    await self._create_process(
+                        current_command, stdin, stdout, stderr))
+                # Close the pipe ends inherited by the child process
+                for parent_fd in (stdin, stdout):
+                    if parent_fd in parent_fds:
+                        parent_fds.remove(parent_fd)
+                        os.close(parent_fd)
+                    #
+                #
+                stdin = read_fd
+            #
+        except BaseException:
+            for parent_fd in parent_fds:
+                os.close(parent_fd)
+            #
+            await self._kill_all(processes)
+            raise
+        finally:
+            # Close files opened for the first and the last command
+            exit_stack.close()
+        #
+        communications = [processes[0].communicate(input_)]
+        communications.extend(
+            current_process.communicate()
+            for current_process in processes[1:])
+        try:
+            all_outputs = await asyncio.wait_for(
+                asyncio.gather(*communications),
+                self._remaining_seconds())
+        except asyncio.TimeoutError as timeout_error:
+            await self._kill_all(processes)
+            raise subprocess.TimeoutExpired(
+                self.commands[last_command_index],
+                self.call_arguments.timeout) from timeout_error
+        except BaseException:
+            # e.g. cancellation of the awaiting task
+            await self._kill_all(processes)
+            raise
+        #
+        self.all_results.clear()
+        for current_command, current_process, (stdout, stderr) in zip(
+                self.commands, processes, all_outputs):
+            self.all_results.append(
+                self._collected_result(
+                    current_command,
+                    current_process.returncode,
+                    stdout,
+                    stderr))
+        #
+        self.result = self.all_results[last_command_index]
+        self._check(self.result)
+
+
+class PipelineTemplate():
+
+    """Factory for pipelines with the same commands and arguments,
+    parsing and validating the commands only once.
+
+    Each argument of a command may contain placeholders
+    in string.Template syntax ($name or ${name})
+    which are substituted when creating a pipeline.
+    Every argument containing a $ sign is treated as a template,
+    so a literal $ (e.g. for shell variables) must be written as $$.
+    A substituted value always remains a single argument.
+    Executables are resolved on PATH (taken from the env argument
+    if provided) unless resolve_executables is False.
+    """
+
+    def __init__(self, *commands, pipeline_class=ProcessPipeline,
+                 resolve_executables=True, **kwargs):
+        """Parse the commands and validate the arguments"""
+        self.pipeline_class = pipeline_class
+        self.kwargs = kwargs
+        # Validate the arguments using a prototype instance
+        kwargs = dict(kwargs, execute_immediately=False)
+        prototype = pipeline_class(*commands, **kwargs)
+        resolve_executables = resolve_executables \
+            and not prototype.process_arguments['shell'] \
+            and prototype.process_arguments['executable'] is None
+        environment = prototype.process_arguments['env']
+        if environment is None:
+            search_path = None
+        else:
+            search_path = environment.get('PATH', os.defpath)
+        #
+        self.commands = []
+        for single_command in prototype.commands:
+            if callable(single_command):
+                self.commands.append(single_command)
+                continue
+            #
+            compiled_command = [
+                self.__compile(argument) for argument in single_command]
+            executable = compiled_command[0]
+            if resolve_executables and isinstance(executable, str) \
+                    and os.sep not in executable:
+                resolved_path = shutil.which(executable, path=search_path)
+                if resolved_path is None:
+                    raise FileNotFoundError(
+                        'Command not found on PATH: {0!r}'.format(
+                            executable))
+                #
+                compiled_command[0] = resolved_path
+            #
+            self.commands.append(compiled_command)
+        #
+
+    @staticmethod
+    def __compile(argument):
+        """Return a template for an argument containing a $ sign
+        (raising a ValueError if it is not followed by a valid
+        placeholder or another $), or the unchanged argument otherwise
+        """
+        if isinstance(argument, str) and '$' in argument:
+            argument_template = templates.EnhancedStringTemplate(argument)
+            # pylint: disable=no-member ; false positive on Template.pattern
+            for placeholder_match in argument_template.pattern.finditer(
+                    argument):
+                if placeholder_match.group('invalid') is not None:
+                    raise ValueError(
+                        'Invalid placeholder in argument {0!r}'
+                        ' (please write a literal $ as $$).'.format(
+                            argument))
+                #
+            #
+            return argument_template
+        #
+        return argument
+
+    @property
+    def variable_names(self):
+        """Return the set of placeholder names in all commands"""
+        result = set()
+        for single_command in self.commands:
+            if callable(single_command):
+                continue
+            #
+            for argument in single_command:
+                if isinstance(argument, templates.EnhancedStringTemplate):
+                    result.update(argument.variable_names)
+                #
+            #
+        #
+        return result
+
+    def substitute(self, values=None):
+        """Return the list of commands with all placeholders
+        substituted from the values mapping
+        (raising a KeyError for missing values)
+        """
+        values = values or {}
+        substituted_commands = []
+        for single_command in self.commands:
+            if callable(single_command):
+                substituted_commands.append(single_command)
+                continue
+            #
+            substituted_commands.append([
+                argument.substitute(values)
+                if isinstance(argument, templates.EnhancedStringTemplate)
+                else argument
+                for argument in single_command])
+        #
+        return substituted_commands
+
+    def create(self, values=None, **kwargs):
+        """Return a new pipeline instance with the placeholders
+        substituted from the values mapping. The keyword arguments
+        override the ones provided at template creation.
+        """
+        pipeline_kwargs = dict(self.kwargs)
+        pipeline_kwargs.update(kwargs)
+        return self.pipeline_class(*self.substitute(values),
+                                   **pipeline_kwargs)
+
+    def run(self, values=None, **kwargs):
+        """Create a pipeline instance, run it immediately
+        and return its result
+        """
+        kwargs['execute_immediately'] = True
+        return self.create(values, **kwargs).result
+
+
+#
+# Functions
+#
+
+
+def run_many(pipeline_specs, max_workers=None, ordered=True):
+    """Execute the given (not yet executed) ProcessPipeline
+    or ProcessChain instances in a thread pool,
+    with at most max_workers (default: the number of CPUs)
+    pipelines running at the same time.
+    Return an iterator over namespaces with the attributes
+    pipeline, result and exception (one of the latter is None),
+    in submission order if ordered is True,
+    else in the order the pipelines completed.
+    Exceptions raised by single pipelines do not abort the batch.
+    Raise a ValueError if any pipeline is not in the ready state.
+    """
+    pipeline_specs = list(pipeline_specs)
+    for single_pipeline in pipeline_specs:
+        if isinstance(single_pipeline, _AbstractAsyncPipeline) \
+                or not isinstance(single_pipeline, _AbstractPipeline):
+            raise ValueError(
+                'Unsupported pipeline: {0!r}'.format(single_pipeline))
+        #
+        if single_pipeline.current_state != single_pipeline.states.ready:
+            raise ValueError(
+                'Pipeline not ready: {0!r} (please create it using'
+                ' execute_immediately=False).'.format(single_pipeline))
+        #
+    #
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers or os.cpu_count() or 1)
+    futures = {
+        executor.submit(single_pipeline.execute): single_pipeline
+        for single_pipeline in pipeline_specs}
+    # Pending futures are still executed after shutdown
+    executor.shutdown(wait=False)
+    if ordered:
+        futures_sequence = list(futures)
+    else:
+        futures_sequence = concurrent.futures.as_completed(futures)
+    #
+    return _iter_outcomes(futures_sequence, futures)
+
+
+def _iter_outcomes(futures_sequence, futures):
+    """Generator function yielding a namespace
+    for each pipeline future
+    """
+    for future in futures_sequence:
+        single_pipeline = futures[future]
+        exception = future.exception()
+        if exception is None:
+            result = single_pipeline.result
+        else:
+            result = None
         #
-        self.current_state = self.states.finished
+        yield namespaces.Namespace(
+            pipeline=single_pipeline,
+            result=result,
+            exception=exception)
+    #
 
 
 # vim:fileencoding=utf-8 autoindent ts=4 sw=4 sts=4 expandtab:
@@ -12,6 +12,7 @@ with additional functions to read and write text files.
 
 import codecs
 import os.path
+import re
 import shutil
 
 from smallparts import constants
@@ -28,6 +29,9 @@ BOM_ASSIGNMENTS = (
     (codecs.BOM_UTF16_LE, 'utf_16_le'),
     (codecs.BOM_UTF8, 'utf_8_sig'))
 
+# Any non-ASCII byte
+PRX_NON_ASCII = re.compile(b'[\x80-\xff]')
+
 DEFAULT_TARGET_ENCODING = constants.UTF_8
 DEFAULT_FALLBACK_ENCODING = constants.CP1252
 DEFAULT_LINE_ENDING = constants.LF
@@ -283,4 +287,111 @@ def transcode_file(file_name,
     #
 
 
+#
+# Classes
+#
+
+
+class EncodingDetectingDecoder(codecs.IncrementalDecoder):
+
+    """Incremental decoder applying the logic of
+    to_unicode_and_encoding_name() to a stream of byte strings:
+        - Use from_encoding if it was given.
+        - Else, detect a Byte Order Mark from BOM_ASSIGNMENTS
+          at the start of the stream.
+        - Else, pass ASCII data through until data containing
+          non-ASCII bytes arrives. Decode that and all following data
+          using UTF-8 if it is valid UTF-8,
+          using fallback_encoding otherwise.
+    The detected encoding name is available in the encoding attribute
+    (None until it has been determined).
+    Contrary to to_unicode_and_encoding_name(), the decision
+    is based on the first chunk of data containing non-ASCII bytes,
+    so an invalid UTF-8 sequence in a later chunk raises
+    a UnicodeDecodeError (or is handled according to errors).
+    """
+
+    max_bom_length = max(len(bom) for (bom, encoding) in BOM_ASSIGNMENTS)
+
+    def __init__(self,
+                 errors='strict',
+                 from_encoding=None,
+                 fallback_encoding=DEFAULT_FALLBACK_ENCODING):
+        """Store the parameters"""
+        super().__init__(errors=errors)
+        self.from_encoding = from_encoding
+        self.fallback_encoding = fallback_encoding
+        self.encoding = None
+        self.__bom_checked = False
+        self.__decoder = None
+        self.__pending = b''
+        self.reset()
+
+    def __select(self, encoding):
+        """Set the encoding and create the matching decoder"""
+        self.encoding = encoding
+        self.__decoder = codecs.getincrementaldecoder(encoding)(
+            errors=self.errors)
+
+    def decode(self, input, final=False):
+        """Decode input, buffering data
+        as long as the encoding cannot be determined
+        """
+        # pylint: disable=redefined-builtin ; codecs API
+        if self.__decoder:
+            return self.__decoder.decode(input, final)
+        #
+        data = self.__pending + input
+        self.__pending = b''
+        if not self.__bom_checked:
+            if not final and len(data) < self.max_bom_length and any(
+                    bom.startswith(data) for (bom, encoding)
+                    in BOM_ASSIGNMENTS):
+                # Could still become a Byte Order Mark
+                self.__pending = data
+                return ''
+            #
+            self.__bom_checked = True
+            for (bom, encoding) in BOM_ASSIGNMENTS:
+                if data.startswith(bom):
+                    self.__select(encoding)
+                    return self.__decoder.decode(data[len(bom):], final)
+                #
+            #
+        #
+        non_ascii_match = PRX_NON_ASCII.search(data)
+        if not non_ascii_match:
+            if final:
+                self.encoding = constants.UTF_8
+            #
+            return data.decode('ascii')
+        #
+        ascii_length = non_ascii_match.start()
+        try:
+            consumed_length = codecs.utf_8_decode(
+                data[ascii_length:], 'strict', final)[1]
+        except UnicodeDecodeError:
+            self.__select(self.fallback_encoding)
+        else:
+            if not consumed_length:
+                # Incomplete UTF-8 sequence: wait for more data
+                self.__pending = data[ascii_length:]
+                return data[:ascii_length].decode('ascii')
+            #
+            self.__select(constants.UTF_8)
+        #
+        return self.__decoder.decode(data, final)
+
+    def reset(self):
+        """Reset the decoder to its initial state"""
+        self.__pending = b''
+        self.__bom_checked = False
+        if self.from_encoding:
+            self.__select(self.from_encoding)
+        else:
+            self.encoding = None
+            self.__decoder = None
+        #
+
+
 # vim:fileencoding=utf-8 autoindent ts=4 sw=4 sts=4 expandtab:
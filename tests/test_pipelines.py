@@ -6,9 +6,18 @@ test smallparts.pipelines
 
 """
 
+import asyncio
+import concurrent.futures
+import json
+import os
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+from smallparts import namespaces
 from smallparts import pipelines
 
 
@@ -72,18 +81,238 @@ class TestSimple(unittest.TestCase):
         self.assertEqual(
             pipeline_call.result.stdout,
             b'u\n')
+        self.assertEqual(
+            pipelines.ProcessPipeline(
+                ['tr', 'x', '-'],
+                ['tr', '-', 'u'],
+                input=b'a x b x c').result.stdout,
+            b'a u b u c')
         self.assertWarns(
             UserWarning,
             pipelines.ProcessPipeline,
             ['echo', 'x'],
             ['tr', '-', 'u'],
-            input=b'a x b x c')
-        self.assertWarns(
-            UserWarning,
+            intermediate_stderr='invalid')
+
+    def test_pipeline_input(self):
+        """Input for multi-stage pipelines"""
+        pipeline_call = pipelines.ProcessPipeline(
+            ['tr', 'a', 'b'],
+            ['wc', '-c'],
+            input=(b'a' * 1000 for unused_number in range(1000)))
+        self.assertEqual(pipeline_call.result.stdout.strip(), b'1000000')
+        with tempfile.TemporaryFile() as input_file:
+            input_file.write(b'abc\n' * 50000)
+            input_file.seek(0)
+            pipeline_call = pipelines.ProcessPipeline(
+                ['tr', 'a', 'x'],
+                ['sort', '-u'],
+                input=input_file)
+        #
+        self.assertEqual(pipeline_call.result.stdout, b'xbc\n')
+        pipeline_call = pipelines.ProcessPipeline(
+            ['cat'],
+            ['sed', 's/a/ä/g'],
+            encoding='utf-8',
+            execute_immediately=False)
+        pipeline_call.execute(input=['abc\n', 'cba\n'])
+        self.assertEqual(pipeline_call.result.stdout, 'äbc\ncbä\n')
+        # stdin=PIPE without input means empty input
+        self.assertEqual(
+            pipelines.ProcessPipeline.run(
+                'cat', stdin=pipelines.PIPE, timeout=5).stdout,
+            b'')
+        # Errors while writing the input are re-raised
+        self.assertRaises(
+            TypeError,
             pipelines.ProcessPipeline,
-            ['echo', 'x'],
-            ['tr', '-', 'u'],
+            ['cat'],
+            ['cat'],
+            input='abc',
+            timeout=5)
+
+        def failing_input():
+            """Raise an error after the first chunk"""
+            yield b'abc\n'
+            raise ValueError('input failed')
+        #
+        for timeout in (None, 5):
+            pipeline_call = pipelines.ProcessPipeline(
+                ['sleep', '30'],
+                ['cat'],
+                timeout=timeout,
+                execute_immediately=False)
+            start_time = time.monotonic()
+            with self.assertRaisesRegex(ValueError, 'input failed'):
+                pipeline_call.execute(input=failing_input())
+            #
+            # The stages have been killed
+            self.assertLess(time.monotonic() - start_time, 5)
+        #
+
+    def test_intermediate_stderr_capture(self):
+        """Capture stderr of all commands"""
+        pipeline_call = pipelines.ProcessPipeline(
+            ['sh', '-c', 'echo out; echo first >&2'],
+            ['sh', '-c', 'cat; echo second >&2'],
+            ['ls', '-1d'],
             intermediate_stderr=pipelines.PIPE)
+        self.assertEqual(
+            [result.stderr for result in pipeline_call.all_results],
+            [b'first\n', b'second\n', b''])
+        self.assertIs(pipeline_call.all_results[-1], pipeline_call.result)
+        self.assertEqual(pipeline_call.result.stdout, b'.\n')
+        # A stage writing much more than a pipe buffer to stderr
+        chatty_pipeline = pipelines.ProcessPipeline(
+            ['sh', '-c', 'seq 200000 >&2; echo done'],
+            ['cat'],
+            intermediate_stderr=pipelines.PIPE,
+            timeout=10)
+        self.assertEqual(chatty_pipeline.result.stdout, b'done\n')
+        self.assertEqual(
+            chatty_pipeline.all_results[0].stderr.splitlines()[-1],
+            b'200000')
+        chain = pipelines.ProcessChain(
+            ['sh', '-c', 'echo out; echo first >&2'],
+            ['cat'],
+            intermediate_stderr=pipelines.PIPE,
+            encoding='utf-8')
+        self.assertEqual(chain.all_results[0].stderr, 'first\n')
+        self.assertEqual(chain.result.stdout, 'out\n')
+
+    def test_pipeline_streaming(self):
+        """Streamed pipeline output"""
+        pipeline_call = pipelines.ProcessPipeline(
+            ['printf', 'a x\\nb x\\nc'],
+            ['tr', 'x', 'u'],
+            execute_immediately=False)
+        self.assertEqual(
+            list(pipeline_call.iter_lines()),
+            [b'a u\n', b'b u\n', b'c'])
+        self.assertEqual(pipeline_call.result.returncode, 0)
+        self.assertIsNone(pipeline_call.result.stdout)
+        self.assertRaises(
+            pipelines.IllegalStateException,
+            pipeline_call.iter_stdout)
+        self.assertEqual(
+            list(
+                pipelines.ProcessPipeline(
+                    ['tr', 'x', 'u'],
+                    input='a x b',
+                    encoding='utf-8',
+                    execute_immediately=False).iter_stdout(chunk_size=2)),
+            ['a ', 'u ', 'b'])
+        streaming_pipeline = pipelines.ProcessPipeline(
+            'seq 100000', execute_immediately=False)
+        lines = streaming_pipeline.iter_lines(chunk_size=16)
+        self.assertEqual(next(lines), b'1\n')
+        lines.close()
+        self.assertEqual(
+            streaming_pipeline.current_state,
+            pipelines.ProcessPipeline.states.finished)
+        self.assertRaises(
+            subprocess.TimeoutExpired,
+            list,
+            pipelines.ProcessPipeline(
+                'sleep 10',
+                timeout=1,
+                execute_immediately=False).iter_stdout())
+        self.assertRaises(
+            subprocess.CalledProcessError,
+            list,
+            pipelines.ProcessPipeline(
+                'mkdir .',
+                check=True,
+                execute_immediately=False).iter_stdout())
+
+    def test_iter_records(self):
+        """Streamed JSON Lines and NUL-delimited records"""
+        json_lines = b'{"name": "a", "size": 1}\n\n{"name": "b", "size": 2}\n'
+        records = pipelines.ProcessPipeline(
+            ['cat'],
+            input=json_lines,
+            execute_immediately=False).iter_records(
+                decode_json=True, as_namespace=True)
+        first_record = next(records)
+        self.assertIsInstance(first_record, namespaces.Namespace)
+        self.assertEqual((first_record.name, first_record.size), ('a', 1))
+        self.assertEqual([record.name for record in records], ['b'])
+        self.assertEqual(
+            list(
+                pipelines.ProcessPipeline(
+                    ['printf', 'a b\\0c\\nd\\0'],
+                    encoding='utf-8',
+                    execute_immediately=False).iter_records(
+                        record_separator=b'\0', chunk_size=3)),
+            ['a b', 'c\nd'])
+        self.assertRaises(
+            ValueError,
+            pipelines.ProcessPipeline(
+                'true', execute_immediately=False).iter_records,
+            record_separator='')
+
+    def test_compress_output(self):
+        """Compressed capture with lazy decompression"""
+        for method in (pipelines.ZLIB, pipelines.LZMA):
+            pipeline_call = pipelines.ProcessPipeline(
+                ['seq', '100000'],
+                ['cat'],
+                compress_output=method,
+                intermediate_stderr=pipelines.PIPE)
+            result = pipeline_call.result
+            self.assertEqual(result.stdout_bytes, 588895)
+            self.assertLess(result.stdout_compressed_bytes, 250000)
+            self.assertEqual(result.stdout[-13:], b'99999\n100000\n')
+            self.assertEqual(pipeline_call.all_results[0].stderr, b'')
+        #
+        chain = pipelines.ProcessChain(
+            ['seq', '1000'],
+            ['wc', '-l'],
+            compress_output=pipelines.ZLIB,
+            max_output_bytes=100,
+            encoding='utf-8')
+        self.assertEqual(chain.all_results[0].stdout[:4], '1\n2\n')
+        self.assertIsNotNone(chain.all_results[0].stdout_compressed_bytes)
+        self.assertEqual(chain.result.stdout.strip(), '1000')
+        self.assertIsNone(chain.result.stdout_compressed_bytes)
+        self.assertRaises(
+            ValueError,
+            pipelines.ProcessPipeline,
+            'true',
+            compress_output='gzip')
+
+    def test_detect_encoding(self):
+        """Decode output in a detected encoding"""
+        pipeline_call = pipelines.ProcessPipeline(
+            ['cat'],
+            input=b'\xff\xfea\x00\r\x00\n\x00',
+            detect_encoding=True)
+        self.assertEqual(pipeline_call.result.stdout, 'a\n')
+        self.assertEqual(pipeline_call.result.stdout_encoding, 'utf_16_le')
+        chain = pipelines.ProcessChain(
+            ['cat'],
+            ['cat'],
+            input=b'caf\xe9\n',
+            detect_encoding=True)
+        self.assertEqual(chain.all_results[0].stdout, b'caf\xe9\n')
+        self.assertEqual(chain.result.stdout, 'café\n')
+        self.assertEqual(chain.result.stdout_encoding, 'cp1252')
+        streaming_pipeline = pipelines.ProcessPipeline(
+            ['cat'],
+            input=b'\xef\xbb\xbfx\xc3\xa4\ny\n',
+            detect_encoding=True,
+            execute_immediately=False)
+        self.assertEqual(
+            list(streaming_pipeline.iter_lines(chunk_size=2)),
+            ['xä\n', 'y\n'])
+        self.assertEqual(
+            streaming_pipeline.result.stdout_encoding, 'utf_8_sig')
+        self.assertRaises(
+            ValueError,
+            pipelines.ProcessPipeline,
+            'true',
+            detect_encoding=True,
+            encoding='utf-8')
 
     def test_single_command_chain(self):
         """Single command call"""
@@ -114,6 +343,135 @@ class TestSimple(unittest.TestCase):
             '^Please provide at least one command.',
             pipelines.ProcessChain)
 
+    def test_fan_out_pipeline(self):
+        """Output copied to several branches"""
+        head_template = pipelines.ProcessChain(
+            ['head', '-n', '2'],
+            execute_immediately=False)
+        with tempfile.TemporaryDirectory() as temp_directory:
+            output_path = os.path.join(temp_directory, 'output.txt')
+            fan_out = pipelines.FanOutPipeline(
+                ['seq', '100000'],
+                ['tr', '9', 'x'],
+                branches=[
+                    [['wc', '-l']],
+                    ['grep x', 'wc -l'],
+                    head_template,
+                    pipelines.ProcessPipeline(
+                        'cat',
+                        stdout=output_path,
+                        execute_immediately=False)])
+            with open(output_path, 'rb') as output_file:
+                self.assertEqual(len(output_file.read().splitlines()), 100000)
+            #
+        #
+        self.assertEqual(fan_out.result.returncode, 0)
+        self.assertIsNone(fan_out.result.stdout)
+        self.assertEqual(
+            [branch.result.stdout for branch in fan_out.branches[:3]],
+            [b'100000\n', b'40951\n', b'1\n2\n'])
+        self.assertIsNone(head_template.result)
+        # Stop the command after all branches have exited
+        fan_out = pipelines.FanOutPipeline(
+            ['yes'],
+            branches=['head -c 4', 'head -c 100000'],
+            timeout=5)
+        self.assertEqual(fan_out.result.returncode, -13)
+        self.assertEqual(fan_out.branches[0].result.stdout, b'y\ny\n')
+        # Keep draining stderr pipes and honouring the timeout
+        fan_out = pipelines.FanOutPipeline(
+            ['sh', '-c', 'seq 100000; seq 100000 >&2'],
+            ['cat'],
+            branches=['head -c 10'],
+            intermediate_stderr=pipelines.PIPE,
+            timeout=5)
+        self.assertEqual(
+            [result.returncode for result in fan_out.all_results], [0, -13])
+        self.assertEqual(
+            len(fan_out.all_results[0].stderr.splitlines()), 100000)
+        self.assertRaises(
+            subprocess.TimeoutExpired,
+            pipelines.FanOutPipeline,
+            ['sh', '-c', 'yes; sleep 30'],
+            ['cat'],
+            branches=['head -c 10'],
+            intermediate_stderr=pipelines.PIPE,
+            timeout=1)
+        self.assertRaises(
+            subprocess.CalledProcessError,
+            pipelines.FanOutPipeline,
+            ['seq', '3'],
+            branches=[
+                'cat',
+                pipelines.ProcessPipeline(
+                    'false', check=True, execute_immediately=False)])
+        self.assertRaises(
+            ValueError,
+            pipelines.FanOutPipeline,
+            ['seq', '3'],
+            branches=[])
+        self.assertRaises(
+            TypeError,
+            pipelines.FanOutPipeline(
+                ['seq', '3'],
+                branches=['cat'],
+                execute_immediately=False).iter_stdout)
+
+    def test_coprocess_pipeline(self):
+        """Persistent pipeline processing many records"""
+        with pipelines.CoprocessPipeline(
+                ['sed', '-u', 's/a/x/'],
+                ['cat']) as coprocess:
+            self.assertEqual(coprocess.process_record(b'a1'), b'x1')
+            self.assertEqual(
+                list(coprocess.process_records(
+                    b'ba%d' % number for number in range(10000)))[-1],
+                b'bx9999')
+            # Abandon an iterator with pending records
+            records_iterator = coprocess.process_records([b'a2', b'a3'])
+            self.assertEqual(next(records_iterator), b'x2')
+            records_iterator.close()
+            self.assertEqual(coprocess.process_record(b'a4'), b'x4')
+        #
+        self.assertEqual(coprocess.result.returncode, 0)
+        self.assertEqual(len(coprocess.all_results), 2)
+        self.assertRaises(
+            pipelines.IllegalStateException,
+            coprocess.process_record,
+            b'a5')
+        coprocess = pipelines.CoprocessPipeline(
+            ['sed', '-u', '-z', 's/a/A/'],
+            record_separator='\0',
+            universal_newlines=True)
+        self.assertEqual(
+            list(coprocess.process_records(['abc', 'dä'])),
+            ['Abc', 'dä'])
+        coprocess.close()
+        coprocess = pipelines.CoprocessPipeline(['head', '-n', '1'])
+        self.assertRaises(
+            pipelines.IllegalStateException,
+            list,
+            coprocess.process_records([b'1', b'2', b'3']))
+        coprocess = pipelines.CoprocessPipeline(['sleep', '5'], timeout=0.2)
+        self.assertRaises(
+            subprocess.TimeoutExpired,
+            coprocess.process_record,
+            b'x')
+        self.assertEqual(coprocess.result.returncode, -9)
+        self.assertRaises(
+            ValueError,
+            pipelines.CoprocessPipeline,
+            'cat',
+            input=b'x')
+        coprocess = pipelines.CoprocessPipeline(
+            'cat', execute_immediately=False)
+        for method in (coprocess.start,
+                       coprocess.iter_stdout,
+                       coprocess.iter_lines,
+                       coprocess.iter_records):
+            self.assertRaises(TypeError, method)
+        #
+
     def test_chain(self):
         """Shell ProcessChain call"""
         pipeline_call = pipelines.ProcessChain(
@@ -131,6 +489,844 @@ class TestSimple(unittest.TestCase):
                 input=b'a x b x c').stdout,
             b'a u b u c')
 
+    def test_chain_spill_to_disk(self):
+        """ProcessChain with intermediate output in temporary files"""
+        chain = pipelines.ProcessChain(
+            ['tr', 'x', '-'],
+            ['tr', '-', 'y'],
+            ['tr', 'y', 'u'],
+            input=b'a x b x c',
+            spill_to_disk=True)
+        self.assertEqual(chain.result.stdout, b'a u b u c')
+        self.assertEqual(len(chain.all_results), 3)
+        self.assertIsNone(chain.all_results[0].stdout)
+        repeated_chain = chain.repeat()
+        self.assertEqual(repeated_chain.result.stdout, b'a u b u c')
+        self.assertIsNone(repeated_chain.all_results[1].stdout)
+        chain = pipelines.ProcessChain(
+            ['tr', 'x', '-'],
+            ['tr', '-', 'u'],
+            input=b'a x b x c',
+            keep_intermediate_results=False)
+        self.assertEqual(chain.all_results, [chain.result])
+        self.assertEqual(chain.result.stdout, b'a u b u c')
+        # The caller’s stdin file object is left open
+        with tempfile.TemporaryFile() as input_file:
+            input_file.write(b'abc\n')
+            for spill_to_disk in (False, True):
+                input_file.seek(0)
+                chain = pipelines.ProcessChain(
+                    ['cat'],
+                    ['tr', 'a', 'x'],
+                    stdin=input_file,
+                    spill_to_disk=spill_to_disk)
+                self.assertEqual(chain.result.stdout, b'xbc\n')
+                self.assertFalse(input_file.closed)
+            #
+        #
+        self.assertRaises(
+            subprocess.CalledProcessError,
+            pipelines.ProcessChain,
+            ['ls'],
+            ['mkdir', '.'],
+            ['cat'],
+            check=True,
+            spill_to_disk=True)
+
+    def test_chain_result_cache(self):
+        """ProcessChain with a result cache"""
+        with tempfile.TemporaryDirectory() as cache_directory:
+            result_cache = pipelines.ResultCache(
+                cache_directory, max_size=20)
+            for spill_to_disk in (False, True):
+                chain = pipelines.ProcessChain(
+                    ['tr', 'a', 'b'],
+                    ['rev'],
+                    input=b'aaax\n',
+                    spill_to_disk=spill_to_disk,
+                    result_cache=result_cache)
+                self.assertEqual(chain.result.stdout, b'xbbb\n')
+            #
+            self.assertEqual(result_cache.misses, 2)
+            self.assertEqual(result_cache.hits, 2)
+            self.assertEqual(result_cache.size, 10)
+            # Failed commands are not cached
+            for unused_iteration in range(2):
+                pipelines.ProcessChain(
+                    ['mkdir', '.'],
+                    stdin=pipelines.DEVNULL,
+                    result_cache=result_cache)
+            #
+            self.assertEqual(result_cache.misses, 4)
+            # Eviction of least recently used entries
+            pipelines.ProcessChain(
+                ['tr', 'a', 'b'],
+                input=b'aaay\n' * 3,
+                result_cache=result_cache)
+            self.assertEqual(result_cache.evictions, 1)
+            self.assertEqual(result_cache.size, 20)
+            # Inherited standard input and stderr mixed into the output
+            # prevent caching
+            for unused_iteration in range(2):
+                pipelines.ProcessChain(
+                    ['true'], stdin=None, result_cache=result_cache)
+                pipelines.ProcessChain(
+                    ['sh', '-c', 'echo out; echo err >&2'],
+                    ['cat'],
+                    stdin=pipelines.DEVNULL,
+                    intermediate_stderr=pipelines.STDOUT,
+                    stderr=pipelines.STDOUT,
+                    result_cache=result_cache)
+            #
+            self.assertEqual(result_cache.hits, 2)
+            self.assertEqual(result_cache.misses, 5)
+            self.assertEqual(
+                pipelines.ProcessChain(
+                    ['sh', '-c', 'echo out; echo err >&2'],
+                    stdin=pipelines.DEVNULL,
+                    stderr=pipelines.DEVNULL,
+                    result_cache=result_cache).result.stdout,
+                b'out\n')
+            result_cache.clear()
+            self.assertEqual(result_cache.size, 0)
+        #
+
+    def test_file_endpoints(self):
+        """Paths and file descriptors as stdin and stdout"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_path = os.path.join(temp_dir, 'input.txt')
+            output_path = os.path.join(temp_dir, 'output.txt')
+            with open(input_path, 'wb') as input_file:
+                input_file.write(b'a x b x c')
+            #
+            pipeline_call = pipelines.ProcessPipeline(
+                ['tr', 'x', '-'],
+                ['tr', '-', 'u'],
+                stdin=input_path,
+                stdout=output_path)
+            self.assertIsNone(pipeline_call.result.stdout)
+            with open(output_path, 'rb') as output_file:
+                self.assertEqual(output_file.read(), b'a u b u c')
+            #
+            with open(input_path, 'rb') as input_file:
+                self.assertEqual(
+                    pipelines.ProcessChain.run(
+                        ['tr', 'x', '-'],
+                        ['tr', '-', 'u'],
+                        stdin=input_file.fileno(),
+                        spill_to_disk=True).stdout,
+                    b'a u b u c')
+            #
+            with open(output_path, 'wb') as output_file:
+                pipelines.ProcessChain(
+                    ['tr', 'x', '-'],
+                    ['tr', '-', 'y'],
+                    input=b'x x',
+                    stdout=output_file.fileno())
+            #
+            with open(output_path, 'rb') as output_file:
+                self.assertEqual(output_file.read(), b'y y')
+            #
+            self.assertRaises(
+                OSError,
+                pipelines.ProcessPipeline,
+                'cat',
+                stdin=os.path.join(temp_dir, 'missing.txt'))
+            self.assertRaises(
+                ValueError,
+                pipelines.ProcessPipeline,
+                'cat',
+                input=b'x',
+                stdin=input_path)
+        #
+
+    def test_callable_stages(self):
+        """Python callables as commands"""
+        def select_x(lines):
+            """Select lines containing x"""
+            return (line for line in lines if b'x' in line)
+        #
+        def upper(lines):
+            """Convert to upper case"""
+            for line in lines:
+                yield line.upper()
+            #
+        #
+        pipeline_call = pipelines.ProcessPipeline(
+            ['printf', 'ax\\nb\\ncx\\n'],
+            select_x,
+            ['tr', 'x', 'u'],
+            upper,
+            collect_stats=True)
+        self.assertEqual(pipeline_call.result.stdout, b'AU\nCU\n')
+        self.assertEqual(pipeline_call.result.args, upper)
+        self.assertEqual(
+            [result.returncode for result in pipeline_call.all_results],
+            [0, 0, 0, 0])
+        self.assertEqual(pipeline_call.stats[1].args, select_x)
+        self.assertIsNone(pipeline_call.stats[1].max_rss)
+        self.assertEqual(
+            pipelines.ProcessPipeline.run(
+                upper, input=b'abc\n').stdout,
+            b'ABC\n')
+        self.assertEqual(
+            pipelines.ProcessChain.run(
+                ['tr', 'x', '-'],
+                upper,
+                ['tr', '-', 'u'],
+                input=b'a x b x c').stdout,
+            b'A u B u C')
+        self.assertEqual(
+            pipelines.ProcessChain.run(
+                upper,
+                upper,
+                input=b'a x b x c',
+                spill_to_disk=True).stdout,
+            b'A X B X C')
+        self.assertEqual(
+            list(
+                pipelines.ProcessPipeline(
+                    'seq 3', select_x, execute_immediately=False)
+                .iter_lines()),
+            [])
+        failing_pipeline = pipelines.ProcessPipeline(
+            'seq 3', lambda lines: [line.decode() for line in lines])
+        self.assertEqual(failing_pipeline.result.returncode, 1)
+        self.assertIsInstance(failing_pipeline.result.exception, TypeError)
+        self.assertIsNone(failing_pipeline.all_results[0].exception)
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            pipelines.ProcessPipeline(
+                'seq 3',
+                lambda lines: 1 / 0,
+                check=True)
+        #
+        self.assertIsInstance(
+            context.exception.__cause__, ZeroDivisionError)
+        # Early termination of a callable writing more than a pipe buffer
+        lines = pipelines.ProcessPipeline(
+            lambda unused_lines: (b'x' * 1000 for unused in range(1000)),
+            execute_immediately=False).iter_stdout(chunk_size=1000)
+        self.assertEqual(next(lines), b'x' * 1000)
+        lines.close()
+        self.assertRaises(
+            ValueError,
+            pipelines.ProcessPipeline,
+            'seq 3',
+            upper,
+            encoding='utf-8')
+        self.assertRaises(
+            ValueError,
+            pipelines.AsyncProcessPipeline,
+            'seq 3',
+            upper)
+
+    def test_parallel_stage(self):
+        """Data-parallel stage replication"""
+        pipeline_call = pipelines.ProcessPipeline(
+            ['seq', '10000'],
+            pipelines.ParallelStage(
+                ['sed', 's/1/x/'], copies=3, block_size=1000),
+            ['tail', '-n', '2'])
+        self.assertEqual(pipeline_call.result.stdout, b'9999\nx0000\n')
+        self.assertEqual(
+            [result.returncode for result in pipeline_call.all_results],
+            [0, 0, 0])
+        pipeline_call = pipelines.ProcessPipeline(
+            ['printf', 'a:b:c'],
+            pipelines.ParallelStage(
+                'tr a-z A-Z', record_separator=b':', block_size=1))
+        self.assertEqual(pipeline_call.result.stdout, b'A:B:C')
+        pipeline_call = pipelines.ProcessPipeline(
+            ['seq', '10'],
+            pipelines.ParallelStage(['sh', '-c', 'exit 3'], block_size=4))
+        self.assertEqual(pipeline_call.result.returncode, 1)
+        self.assertEqual(pipeline_call.result.exception.returncode, 3)
+        self.assertRaises(
+            ValueError,
+            pipelines.ParallelStage,
+            'cat',
+            copies=0)
+
+    def test_bounded_capture(self):
+        """Output limits"""
+        pipeline_call = pipelines.ProcessPipeline(
+            ['seq', '100000'],
+            ['cat'],
+            max_output_bytes=12)
+        self.assertEqual(pipeline_call.result.stdout, b'9999\n100000\n')
+        self.assertTrue(pipeline_call.result.stdout_truncated)
+        self.assertEqual(pipeline_call.result.stdout_bytes, 588895)
+        self.assertEqual(pipeline_call.result.stderr_bytes, 0)
+        self.assertFalse(pipeline_call.result.stderr_truncated)
+        self.assertEqual(
+            pipelines.ProcessPipeline.run(
+                'seq 100000',
+                max_output_bytes=4,
+                retain_output=pipelines.HEAD).stdout,
+            b'1\n2\n')
+        self.assertEqual(
+            pipelines.ProcessChain.run(
+                'seq 100000',
+                'cat',
+                max_output_bytes=6,
+                retain_output=pipelines.HEAD_AND_TAIL).stdout,
+            b'1\n200\n')
+        untruncated_result = pipelines.ProcessPipeline.run(
+            'seq 3', max_output_bytes=6)
+        self.assertEqual(untruncated_result.stdout, b'1\n2\n3\n')
+        self.assertFalse(untruncated_result.stdout_truncated)
+        error_pipeline = pipelines.ProcessPipeline(
+            ['sh', '-c', 'seq 10000 >&2'],
+            ['sh', '-c', 'seq 1000 >&2'],
+            intermediate_stderr=pipelines.PIPE,
+            max_error_bytes=5)
+        self.assertEqual(
+            [(result.stderr, result.stderr_bytes, result.stderr_truncated)
+             for result in error_pipeline.all_results],
+            [(b'0000\n', 48894, True), (b'1000\n', 3893, True)])
+        # Partial characters at the cuts are replaced in text mode
+        self.assertEqual(
+            [pipelines.ProcessPipeline.run(
+                ['printf', 'ääääää'],
+                max_output_bytes=5,
+                retain_output=retain_output,
+                encoding='utf-8').stdout
+             for retain_output in (pipelines.TAIL, pipelines.HEAD)],
+            ['\ufffdää', 'ää\ufffd'])
+        detected_result = pipelines.ProcessPipeline.run(
+            ['printf', 'ääääää'],
+            max_output_bytes=5,
+            detect_encoding=True)
+        self.assertEqual(
+            (detected_result.stdout, detected_result.stdout_encoding),
+            ('\ufffdää', 'utf-8'))
+        self.assertRaises(
+            ValueError,
+            pipelines.ProcessPipeline,
+            'ls',
+            retain_output='middle')
+        for invalid_limit in (-1, 1.5, '10'):
+            self.assertRaises(
+                ValueError,
+                pipelines.ProcessPipeline,
+                'echo hello',
+                max_output_bytes=invalid_limit)
+            self.assertRaises(
+                ValueError,
+                pipelines.ProcessChain,
+                'echo hello',
+                max_error_bytes=invalid_limit)
+        #
+
+    def test_stats(self):
+        """Resource usage statistics"""
+        pipeline_call = pipelines.ProcessPipeline(
+            ['sleep', '0.2'],
+            ['tr', 'x', 'u'],
+            collect_stats=True)
+        self.assertEqual(len(pipeline_call.stats), 2)
+        self.assertEqual(pipeline_call.stats[0].args, ['sleep', '0.2'])
+        self.assertEqual(pipeline_call.stats[0].returncode, 0)
+        self.assertGreaterEqual(pipeline_call.stats[0].wall_time, 0.2)
+        self.assertGreater(pipeline_call.stats[1].max_rss, 0)
+        self.assertGreaterEqual(pipeline_call.stats[1].user_time, 0)
+        self.assertGreaterEqual(pipeline_call.stats[1].system_time, 0)
+        self.assertEqual(
+            pipelines.ProcessPipeline(['ls', '-1d']).stats, [])
+        chain = pipelines.ProcessChain(
+            ['tr', 'x', '-'],
+            ['mkdir', '.'],
+            input=b'x',
+            collect_stats=True)
+        self.assertEqual(
+            [record.returncode for record in chain.stats],
+            [0, 1])
+        self.assertEqual(chain.result.returncode, 1)
+        self.assertRaises(
+            ValueError,
+            pipelines.AsyncProcessChain,
+            'ls',
+            collect_stats=True)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'Linux only')
+    def test_pipe_size(self):
+        """Pipe buffer sizes"""
+        stdin_pipe_size = [
+            sys.executable,
+            '-c',
+            'import fcntl; print(fcntl.fcntl(0, 1032))']
+        self.assertEqual(
+            pipelines.ProcessPipeline(
+                ['echo'],
+                stdin_pipe_size,
+                pipe_size=262144).result.stdout,
+            b'262144\n')
+        self.assertEqual(
+            pipelines.ProcessPipeline(
+                ['echo'],
+                ['cat'],
+                stdin_pipe_size,
+                pipe_size=[None, 131072]).result.stdout,
+            b'131072\n')
+        self.assertEqual(
+            pipelines.ProcessChain(
+                stdin_pipe_size,
+                input=b'x',
+                pipe_size=131072).result.stdout,
+            b'131072\n')
+        self.assertRaises(
+            ValueError,
+            pipelines.ProcessPipeline,
+            ['echo'],
+            ['cat'],
+            pipe_size=[65536, 65536])
+        self.assertRaises(
+            ValueError,
+            pipelines.ProcessPipeline,
+            ['echo'],
+            pipe_size=2 ** 40)
+
+    def test_posix_spawn(self):
+        """Starting processes using os.posix_spawnp()"""
+        pipeline_call = pipelines.ProcessPipeline(
+            ['echo', 'abc'],
+            ['tr', 'b', 'x'],
+            ['cat', '-'],
+            intermediate_stderr=pipelines.PIPE,
+            collect_stats=True,
+            use_posix_spawn=True)
+        self.assertEqual(pipeline_call.result.stdout, b'axc\n')
+        self.assertEqual(
+            [record.returncode for record in pipeline_call.stats],
+            [0, 0, 0])
+        self.assertRaises(
+            subprocess.TimeoutExpired,
+            pipelines.ProcessPipeline,
+            ['sleep', '5'],
+            ['cat'],
+            timeout=0.2,
+            use_posix_spawn=True)
+        self.assertRaises(
+            FileNotFoundError,
+            pipelines.ProcessPipeline,
+            'nonexistent-command',
+            use_posix_spawn=True)
+        # Fallback to subprocess.Popen in text mode
+        chain = pipelines.ProcessChain(
+            ['cat'],
+            ['tr', 'a', 'b'],
+            input='aaa',
+            universal_newlines=True,
+            use_posix_spawn=True)
+        self.assertEqual(chain.result.stdout, 'bbb')
+
+    def test_global_deadline(self):
+        """Single deadline for all commands, process group kill"""
+        start_time = time.monotonic()
+        self.assertRaises(
+            subprocess.TimeoutExpired,
+            pipelines.ProcessChain,
+            ['sleep', '0.4'],
+            ['sleep', '0.4'],
+            ['sleep', '0.4'],
+            timeout=1)
+        self.assertLess(time.monotonic() - start_time, 1.2)
+        with self.assertRaises(subprocess.TimeoutExpired) as context:
+            pipelines.ProcessPipeline(
+                ['sh', '-c', 'sleep 10 & echo $!; wait'],
+                ['cat'],
+                start_new_session=True,
+                timeout=0.5)
+        #
+        self.assertLess(time.monotonic() - start_time, 5)
+        grandchild_pid = int(context.exception.output)
+        # The orphaned sleep process must have been killed
+        # (it may remain a zombie if nobody reaps it)
+        try:
+            with open('/proc/{0}/stat'.format(grandchild_pid)) as stat_file:
+                self.assertEqual(stat_file.read().split(')')[-1].split()[0],
+                                 'Z')
+            #
+        except FileNotFoundError:
+            pass
+        #
+
+    def test_pipeline_template(self):
+        """Precompiled pipeline template"""
+        template = pipelines.PipelineTemplate(
+            'echo "$greeting, ${name}!"',
+            ['tr', 'a-z', 'A-Z'],
+            execute_immediately=False)
+        self.assertEqual(template.variable_names, {'greeting', 'name'})
+        self.assertTrue(os.path.isabs(template.commands[1][0]))
+        self.assertEqual(
+            template.run(dict(greeting='hello', name='big  world')).stdout,
+            b'HELLO, BIG  WORLD!\n')
+        pipeline = template.create(dict(greeting='hi', name='you'))
+        self.assertIsNone(pipeline.result)
+        pipeline.execute()
+        self.assertEqual(pipeline.result.stdout, b'HI, YOU!\n')
+        self.assertRaises(KeyError, template.create, dict(greeting='hi'))
+        self.assertRaises(
+            FileNotFoundError,
+            pipelines.PipelineTemplate,
+            'nonexistent-command $argument')
+        self.assertRaises(
+            ValueError,
+            pipelines.PipelineTemplate,
+            'cat $file',
+            retain_output='invalid')
+        chain_template = pipelines.PipelineTemplate(
+            ['cat', '$file'],
+            pipeline_class=pipelines.ProcessChain,
+            resolve_executables=False)
+        self.assertEqual(chain_template.commands[0][0], 'cat')
+        with tempfile.NamedTemporaryFile() as input_file:
+            input_file.write(b'file contents')
+            input_file.flush()
+            self.assertEqual(
+                chain_template.run(dict(file=input_file.name)).stdout,
+                b'file contents')
+        #
+        # A literal $ is always written as $$
+        shell_template = pipelines.PipelineTemplate(
+            ['sh', '-c', 'echo "$$HOME" $word'],
+            ['sed', 's/$$/ costs $$5/'],
+            env=dict(os.environ, HOME='/home/test'))
+        self.assertEqual(shell_template.variable_names, {'word'})
+        self.assertEqual(
+            shell_template.run(dict(word='hello')).stdout,
+            b'/home/test hello costs $5\n')
+        self.assertRaises(
+            ValueError,
+            pipelines.PipelineTemplate,
+            ['sh', '-c', 'echo $$HOME costs $5'])
+
+    def test_tracer(self):
+        """Chrome trace event export"""
+        tracer = pipelines.PipelineTracer()
+        pipelines.ProcessPipeline(
+            ['cat'],
+            ['tr', 'a', 'b'],
+            input=b'abc',
+            tracer=tracer)
+        pipelines.ProcessChain(['echo', 'x'], ['cat'], tracer=tracer)
+        events = tracer.trace_events
+        self.assertEqual(
+            [(event['pid'], event['args']['name'])
+             for event in events if event['name'] == 'process_name'],
+            [(1, 'ProcessPipeline: cat | tr a b'),
+             (2, 'ProcessChain: echo x | cat')])
+        self.assertEqual(
+            sorted((event['pid'], event['tid'], event['name'])
+                   for event in events if event['ph'] in 'iX'),
+            [(1, 0, 'exit'), (1, 0, 'running'), (1, 0, 'spawn'),
+             (1, 0, 'stdin closed'),
+             (1, 1, 'exit'), (1, 1, 'first output'), (1, 1, 'running'),
+             (1, 1, 'spawn'),
+             (2, 0, 'exit'), (2, 0, 'first output'), (2, 0, 'running'),
+             (2, 0, 'spawn'),
+             (2, 1, 'exit'), (2, 1, 'first output'), (2, 1, 'running'),
+             (2, 1, 'spawn'), (2, 1, 'stdin closed')])
+        with tempfile.TemporaryDirectory() as trace_directory:
+            trace_path = os.path.join(trace_directory, 'trace.json')
+            tracer.export(trace_path)
+            with open(trace_path, encoding='utf-8') as trace_file:
+                self.assertEqual(
+                    len(json.load(trace_file)['traceEvents']), len(events))
+            #
+        #
+
+    def test_cancel(self):
+        """Cooperative cancellation from another thread"""
+        pipeline_call = pipelines.ProcessPipeline(
+            ['sleep', '10'],
+            ['cat'],
+            execute_immediately=False)
+        future = pipeline_call.start()
+        pipeline_call.cancel()
+        self.assertTrue(pipeline_call.cancelled)
+        self.assertEqual(future.result().returncode, -15)
+        self.assertEqual(
+            [result.returncode for result in pipeline_call.all_results],
+            [-15, -15])
+        # SIGTERM is ignored: kill the process group after the grace period
+        pipeline_call = pipelines.ProcessPipeline(
+            ['sh', '-c', 'trap "" TERM; echo ready; sleep 10'],
+            ['cat'],
+            start_new_session=True,
+            execute_immediately=False)
+        lines = pipeline_call.iter_lines()
+        self.assertEqual(next(lines), b'ready\n')
+        start_time = time.monotonic()
+        canceller = threading.Thread(
+            target=pipeline_call.cancel, kwargs=dict(grace_period=0.3))
+        canceller.start()
+        self.assertEqual(list(lines), [])
+        canceller.join()
+        self.assertLess(time.monotonic() - start_time, 5)
+        self.assertEqual(pipeline_call.all_results[0].returncode, -9)
+        # Python callable as the last stage
+        def slow_copy(input_file):
+            """Copy the input lines slowly"""
+            for line in input_file:
+                time.sleep(0.01)
+                yield line
+            #
+        #
+        for cancel_from_future in (False, True):
+            pipeline_call = pipelines.ProcessPipeline(
+                'yes', slow_copy, execute_immediately=False)
+            future = pipeline_call.start()
+            time.sleep(0.2)
+            if cancel_from_future:
+                self.assertTrue(future.cancel())
+            else:
+                canceller = threading.Thread(target=pipeline_call.cancel)
+                canceller.start()
+                canceller.join(5)
+            #
+            self.assertEqual(future.wait(5), -9)
+        #
+        chain = pipelines.ProcessChain('true', execute_immediately=False)
+        chain.cancel()
+        self.assertRaises(pipelines.IllegalStateException, chain.execute)
+
+    def test_start(self):
+        """Non-blocking execution"""
+        futures = [
+            pipelines.ProcessPipeline(
+                ['sleep', '0.2'],
+                ['echo', str(number)],
+                execute_immediately=False).start()
+            for number in range(5)]
+        self.assertEqual([future.poll() for future in futures], [None] * 5)
+        concurrent.futures.wait(futures)
+        self.assertEqual(
+            [future.result().stdout for future in futures],
+            [b'0\n', b'1\n', b'2\n', b'3\n', b'4\n'])
+        self.assertEqual([future.wait() for future in futures], [0] * 5)
+        future = pipelines.ProcessChain(
+            ['sleep', '5'],
+            ['cat'],
+            execute_immediately=False).start()
+        self.assertRaises(subprocess.TimeoutExpired, future.wait, 0.1)
+        self.assertTrue(future.running())
+        self.assertTrue(future.cancel())
+        self.assertIsNone(future.wait(2))
+        self.assertEqual(future.pipeline.all_results[0].returncode, -9)
+        self.assertEqual(len(future.pipeline.all_results), 1)
+        self.assertRaises(concurrent.futures.CancelledError, future.result)
+        future = pipelines.ProcessPipeline(
+            ['false'],
+            check=True,
+            execute_immediately=False).start()
+        self.assertIsInstance(
+            future.exception(), subprocess.CalledProcessError)
+        self.assertEqual(future.poll(), 1)
+        self.assertFalse(future.cancel())
+
+    def test_run_many(self):
+        """Batch execution"""
+        pipeline_specs = [
+            pipelines.ProcessPipeline(
+                ['echo', str(number)],
+                ['tr', '0-9', 'a-j'],
+                execute_immediately=False)
+            for number in range(10)]
+        pipeline_specs.append(
+            pipelines.ProcessChain(
+                'mkdir .', check=True, execute_immediately=False))
+        pipeline_specs.append(
+            pipelines.ProcessChain(
+                ['tr', 'x', 'u'], input=b'x', execute_immediately=False))
+        outcomes = list(pipelines.run_many(pipeline_specs, max_workers=3))
+        self.assertEqual(
+            [outcome.pipeline for outcome in outcomes],
+            pipeline_specs)
+        self.assertEqual(outcomes[7].result.stdout, b'h\n')
+        self.assertIsNone(outcomes[7].exception)
+        self.assertIsInstance(
+            outcomes[10].exception,
+            subprocess.CalledProcessError)
+        self.assertIsNone(outcomes[10].result)
+        self.assertEqual(outcomes[11].result.stdout, b'u')
+        unordered_outcomes = list(
+            pipelines.run_many(
+                [single_pipeline.repeat()
+                 for single_pipeline in pipeline_specs[:5]],
+                ordered=False))
+        self.assertEqual(
+            sorted(outcome.result.stdout for outcome in unordered_outcomes),
+            [b'a\n', b'b\n', b'c\n', b'd\n', b'e\n'])
+        self.assertRaises(
+            ValueError,
+            pipelines.run_many,
+            [pipelines.AsyncProcessPipeline('ls')])
+        self.assertRaises(
+            ValueError,
+            pipelines.run_many,
+            [pipelines.ProcessPipeline('echo a')])
+
+
+class TestAsync(unittest.TestCase):
+
+    """Test the asynchronous pipelines"""
+
+    def setUp(self):
+        """Create an event loop"""
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        """Close the event loop"""
+        self.loop.close()
+
+    def test_async_pipeline(self):
+        """Asynchronous pipeline"""
+        self.assertEqual(
+            self.loop.run_until_complete(
+                pipelines.AsyncProcessPipeline.run(
+                    ['tr', 'x', '-'],
+                    ['tr', '-', 'u'],
+                    input=b'a x b x c')).stdout,
+            b'a u b u c')
+        pipeline_call = pipelines.AsyncProcessPipeline(
+            ['ls', '-1d'], ['tr', '.', 'x'], encoding='utf-8')
+        self.assertIsNone(pipeline_call.result)
+        self.loop.run_until_complete(pipeline_call.execute())
+        self.assertEqual(pipeline_call.result.stdout, 'x\n')
+        self.assertIs(pipeline_call.all_results[-1], pipeline_call.result)
+        self.assertRaises(
+            pipelines.IllegalStateException,
+            self.loop.run_until_complete,
+            pipeline_call.execute())
+        self.assertRaises(TypeError, pipeline_call.start)
+        self.assertRaises(TypeError, pipeline_call.cancel)
+        self.assertRaises(
+            ValueError,
+            pipelines.AsyncProcessPipeline,
+            'ls',
+            execute_immediately=True)
+        self.assertRaises(
+            subprocess.TimeoutExpired,
+            self.loop.run_until_complete,
+            pipelines.AsyncProcessPipeline.run(
+                'sleep 10', 'cat', timeout=1))
+        self.assertRaises(
+            subprocess.TimeoutExpired,
+            self.loop.run_until_complete,
+            pipelines.AsyncProcessChain.run(
+                ['sleep', '0.4'],
+                ['sleep', '0.4'],
+                ['sleep', '0.4'],
+                timeout=1))
+        self.assertRaises(
+            subprocess.CalledProcessError,
+            self.loop.run_until_complete,
+            pipelines.AsyncProcessPipeline.run(
+                'ls', 'mkdir .', check=True))
+        self.assertRaises(
+            OSError,
+            self.loop.run_until_complete,
+            pipelines.AsyncProcessPipeline.run(
+                'ls', 'non-existent-command'))
+
+    def test_async_task_cancellation(self):
+        """Cancelling the awaiting task kills all commands"""
+        async def cancel_soon(pipeline_call):
+            """Execute the pipeline and cancel the task"""
+            task = asyncio.ensure_future(pipeline_call.execute())
+            await asyncio.sleep(0.5)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            #
+        #
+        with tempfile.TemporaryDirectory() as temp_dir:
+            pid_path = os.path.join(temp_dir, 'pid')
+            command = ['sh', '-c', 'echo $$ > {0}; exec sleep 30'.format(
+                pid_path)]
+            for pipeline_class in (pipelines.AsyncProcessChain,
+                                   pipelines.AsyncProcessPipeline):
+                self.loop.run_until_complete(
+                    cancel_soon(pipeline_class(command, ['cat'])))
+                with open(pid_path) as pid_file:
+                    self.assertRaises(
+                        ProcessLookupError,
+                        os.kill,
+                        int(pid_file.read()),
+                        0)
+                #
+            #
+        #
+
+    def test_async_file_endpoints(self):
+        """Asynchronous pipeline with paths as stdin and stdout"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_path = os.path.join(temp_dir, 'input.txt')
+            output_path = os.path.join(temp_dir, 'output.txt')
+            with open(input_path, 'wb') as input_file:
+                input_file.write(b'a x b x c')
+            #
+            self.loop.run_until_complete(
+                pipelines.AsyncProcessPipeline.run(
+                    ['tr', 'x', '-'],
+                    ['tr', '-', 'u'],
+                    stdin=input_path,
+                    stdout=output_path))
+            with open(output_path, 'rb') as output_file:
+                self.assertEqual(output_file.read(), b'a u b u c')
+            #
+            self.assertEqual(
+                self.loop.run_until_complete(
+                    pipelines.AsyncProcessChain.run(
+                        ['tr', 'x', '-'],
+                        ['tr', '-', 'u'],
+                        stdin=input_path)).stdout,
+                b'a u b u c')
+        #
+
+    def test_async_concurrency(self):
+        """Many pipelines in one event loop"""
+        async def run_all():
+            """Run the pipelines concurrently"""
+            return await asyncio.gather(
+                *(pipelines.AsyncProcessPipeline.run(
+                    ['echo', str(number)], ['tr', '0-9', 'a-j'])
+                  for number in range(20)))
+        #
+        results = self.loop.run_until_complete(run_all())
+        self.assertEqual(results[12].stdout, b'bc\n')
+
+    def test_async_intermediate_stderr_capture(self):
+        """Capture stderr of all commands in an asynchronous pipeline"""
+        pipeline_call = pipelines.AsyncProcessPipeline(
+            ['sh', '-c', 'echo out; echo first >&2'],
+            ['cat'],
+            intermediate_stderr=pipelines.PIPE)
+        self.loop.run_until_complete(pipeline_call.execute())
+        self.assertEqual(pipeline_call.all_results[0].stderr, b'first\n')
+        self.assertEqual(pipeline_call.result.stdout, b'out\n')
+
+    def test_async_chain(self):
+        """Asynchronous chain"""
+        chain = pipelines.AsyncProcessChain(
+            ['tr', 'x', '-'],
+            ['tr', '-', 'u'],
+            input=b'a x b x c')
+        self.loop.run_until_complete(chain.execute())
+        self.assertEqual(chain.result.stdout, b'a u b u c')
+        self.assertEqual(chain.all_results[0].stdout, b'a - b - c')
+        repeated_chain = chain.repeat()
+        self.loop.run_until_complete(repeated_chain.execute(input=b'x'))
+        self.assertEqual(repeated_chain.result.stdout, b'u')
+        self.assertRaises(
+            subprocess.CalledProcessError,
+            self.loop.run_until_complete,
+            pipelines.AsyncProcessChain.run('mkdir .', 'cat', check=True))
+
 
 if __name__ == '__main__':
     unittest.main()
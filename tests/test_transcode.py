@@ -46,6 +46,38 @@ class TestSimple(unittest.TestCase):
             transcode.to_unicode_and_encoding_name,
             'Unicode text with €')
 
+    def test_encoding_detecting_decoder(self):
+        """Detect the encoding incrementally"""
+        for (chunks, expected_result) in (
+                ((b'\xff', b'\xfeU\x00', b'T\x00F\x00'),
+                 ('UTF', 'utf_16_le')),
+                ((b'\xff\xfe\x00\x00', b'U\x00\x00\x00'),
+                 ('U', 'utf_32_le')),
+                ((b'UTF-8 Text with \xe2', b'\x82', b'\xac'),
+                 ('UTF-8 Text with €', 'utf-8')),
+                ((b'UTF-8 Text with ', b'\x80'),
+                 ('UTF-8 Text with €', 'cp1252')),
+                ((b'ASCII', b' Text'),
+                 ('ASCII Text', 'utf-8'))):
+            decoder = transcode.EncodingDetectingDecoder()
+            decoded_parts = [decoder.decode(chunk) for chunk in chunks]
+            decoded_parts.append(decoder.decode(b'', final=True))
+            self.assertEqual(
+                (''.join(decoded_parts), decoder.encoding),
+                expected_result)
+        #
+        decoder = transcode.EncodingDetectingDecoder()
+        self.assertEqual(decoder.decode(b'plain '), 'plain ')
+        self.assertIsNone(decoder.encoding)
+        self.assertEqual(decoder.decode(b'\xc3\xa4 '), 'ä ')
+        self.assertRaises(
+            UnicodeDecodeError,
+            decoder.decode,
+            b'\xa4')
+        decoder = transcode.EncodingDetectingDecoder(
+            from_encoding='iso8859-15')
+        self.assertEqual(decoder.decode(b'\xa4', final=True), '€')
+
     def test_to_unicode(self):
         """Decode bytestrings"""
         self.assertEqual(